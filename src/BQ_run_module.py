@@ -5,12 +5,21 @@ import pathlib
 import os
 import sys
 
+import numpy as np
+
+import autotune
+import config
 import metric
 import registration as reg
 import postprocess as post
 import preprocess as pre
+import quantize
 import segmentation as seg
 
+# Registration matrix cache, one per process so its hit and miss counters
+# cover every scan run
+matrix_cache = reg.MatrixCache() if config.registration_cache_size > 0 else None
+
 def run_module(input_path_dict, output_folder_path):
     scans_path = pathlib.Path(input_path_dict['Input Scans'])
     result_path = output_folder_path / pathlib.Path("results.csv")
@@ -22,23 +31,41 @@ def run_module(input_path_dict, output_folder_path):
     name = scans_path.name.split('-')[-1].split('.')[0]
     print("Loading raw scan: FINISHED")
 
-    (mni_scan, affine) = reg.CT_to_MNI(raw_scan)
+    backend = config.registration_backend
+    (mni_scan, affine) = reg.CT_to_MNI(raw_scan, cache=matrix_cache, backend=backend, engine=config.registration_engine)
     print("CT to MNI for Raw Scan: FINISHED")
     (rest, mask) = pre.skullstrip(mni_scan)
     print("Skullstrip scan: FINISHED")
 
-    ct_rest, inverse_affine = reg.MNI_to_CT(rest, raw_scan, affine)
-    ct_mask, _ = reg.MNI_to_CT(mask, raw_scan, reuse=inverse_affine)
-
-    segmented = seg.inference(ct_rest, ct_mask, batch_size=5000)
+    ct_rest, inverse_affine = reg.MNI_to_CT(rest, raw_scan, affine, backend=backend)
+    ct_mask, _ = reg.MNI_to_CT(mask, raw_scan, reuse=inverse_affine, backend=backend)
+
+    model = quantize.resolve_model(config.model_variant)
+
+    batch_size = config.batch_size
+    if batch_size == 'auto':
+        batch_size = autotune.tuned_batch_size(model, default=config.default_batch_size)
+
+    if config.save_probabilities:
+        segmented, probabilities = seg.inference(ct_rest, ct_mask, model=model, batch_size=batch_size,
+                                                 max_patch_bytes=config.max_patch_bytes, probabilities=True,
+                                                 workers=config.inference_workers,
+                                                 slice_options=config.slice_options,
+                                                 connectivity=config.connectivity)
+        np.save(name + "_probabilities.npy", probabilities)
+    else:
+        segmented = seg.inference(ct_rest, ct_mask, model=model, batch_size=batch_size,
+                                  max_patch_bytes=config.max_patch_bytes, workers=config.inference_workers,
+                                  slice_options=config.slice_options, connectivity=config.connectivity)
     print("Inference: FINISHED")
     # breakpoint()
 
-    registered_seg = reg.apply_affine(segmented, affine)
+    registered_seg = reg.apply_affine(segmented, affine, backend=backend)
     print("Segmented to MNI: FINISHED")
-    corrected = post.correct(registered_seg)
+    corrected = post.correct(registered_seg, connectivity=config.connectivity,
+                             slice_options=config.slice_options)
 
-    (final_img, inverse_affine) = reg.MNI_to_CT(corrected, raw_scan, reuse=inverse_affine)
+    (final_img, inverse_affine) = reg.MNI_to_CT(corrected, raw_scan, reuse=inverse_affine, backend=backend)
 
     nib.save(mni_scan, name + "_mni_scan.nii.gz")
     nib.save(rest, name + "_rest.nii.gz")
@@ -50,6 +77,8 @@ def run_module(input_path_dict, output_folder_path):
     final_name = name + "_final.nii.gz"
     nib.save(final_img, final_name)
 
+    reg.clear_caches() # grids and maps of this scan are not reused by the next
+
     #### END PIPELINE 
 
     # Compute metric (commented out for now, so extra corrections can be applied to segmentation)
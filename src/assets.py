@@ -1,13 +1,40 @@
+import logging
 import pathlib
+import threading
+
+import nibabel as nib
+import numpy as np
 
 # ASSETS LOCATION
 parent_dir = pathlib.Path(__file__).resolve().parent
 assets_dir = parent_dir / "assets"
 model_dir = parent_dir
 
+# UNCOMPRESSED ASSET PACK
+# Built once by ./assets.py: templates as uncompressed .nii, and probability
+# maps as uint8 .npy codes into a table of their (few) distinct values (see
+# ProbMap). Both are memory-mapped rather than decompressed by every process,
+# so processes on one node share their pages through the page cache.
+# The pack is used when present and not older than the compressed assets.
+pack_dir = assets_dir / "pack"
+
+def packed(path, suffix):
+    """ Path of the pack version of a compressed asset, or None if not (or no longer) valid.
+    """
+
+    pack = pack_dir / path.name.replace(".nii.gz", suffix)
+
+    if pack.exists() and path.exists() and pack.stat().st_mtime >= path.stat().st_mtime:
+        return pack
+
+    return None
+
 # REGISTRATION FILES
-MNI_152_bone = assets_dir / 'MNI152_T1_1mm_bone.nii.gz'
-MNI_152 = assets_dir / 'MNI152_T1_1mm.nii.gz'
+MNI_152_bone_source = assets_dir / 'MNI152_T1_1mm_bone.nii.gz'
+MNI_152_source = assets_dir / 'MNI152_T1_1mm.nii.gz'
+
+MNI_152_bone = packed(MNI_152_bone_source, ".nii") or MNI_152_bone_source
+MNI_152 = packed(MNI_152_source, ".nii") or MNI_152_source
 
 # PROBABILITY MAPS
 prob_map = {'ventr'      : assets_dir / "MNI_ventr_prob_map_image.nii.gz",      
@@ -17,5 +44,144 @@ prob_map = {'ventr'      : assets_dir / "MNI_ventr_prob_map_image.nii.gz",
             'background' : assets_dir / "MNI_background_prob_map_image.nii.gz", 
            }
 
+# Probability maps loaded so far (see load_prob_map), held once per process
+prob_maps = {}
+prob_maps_lock = threading.Lock()
+
+class ProbMap:
+    """ Probability map stored as uint8 codes into a sorted table of its distinct values.
+
+    Encoding is exact. Indexing decodes only the selected voxels, and
+    thresholds (<, <=, >, >=) compare codes, so neither makes a float copy
+    of the volume; ``np.asarray`` decodes it whole, and is needed for any
+    other array operation.
+
+    Parameters
+    ----------
+
+    codes: numpy.ndarray
+        uint8 volume (typically memory-mapped) of indices into values.
+
+    values: numpy.ndarray
+        Sorted distinct probabilities (float64).
+    """
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values.astype(dtype or self.dtype)[self.codes]
+
+    def __ge__(self, threshold):
+        return self.codes >= np.searchsorted(self.values, threshold, side='left')
+
+    def __gt__(self, threshold):
+        return self.codes >= np.searchsorted(self.values, threshold, side='right')
+
+    def __lt__(self, threshold):
+        return ~(self >= threshold)
+
+    def __le__(self, threshold):
+        return ~(self > threshold)
+
+def encode(data):
+    """ uint8 codes and sorted distinct values of a probability map (see ``ProbMap``).
+    """
+
+    values, codes = np.unique(data, return_inverse=True)
+    if len(values) > 256:
+        raise ValueError(f"{len(values)} distinct values; uint8 codes hold 256")
+
+    return codes.reshape(data.shape).astype(np.uint8), values
+
+def load_prob_map(name):
+    """ Probability map of the given name (a key of ``prob_map``).
+
+    The map is a ``ProbMap``, loaded on first access and cached for the
+    process. From the asset pack its codes are memory-mapped, shared by all
+    processes through the page cache; otherwise they are encoded from the
+    compressed asset.
+    """
+
+    with prob_maps_lock:
+        if name not in prob_maps:
+            pack = packed(prob_map[name], ".codes.npy")
+
+            if pack is None:
+                codes, values = encode(nib.load(prob_map[name]).get_fdata())
+                codes.flags.writeable = False
+            else:
+                values = np.load(pack.with_name(pack.name.replace(".codes.npy", ".values.npy")))
+                codes = np.load(pack, mmap_mode='r')
+
+            prob_maps[name] = ProbMap(codes, values)
+
+    return prob_maps[name]
+
 # MODEL FILES
 model = model_dir / "test_bs200.onnx"
+
+# INT8 dynamically quantized variant of the model, generated by quantize.py
+model_int8 = model.with_suffix(".int8.onnx")
+
+def build_pack():
+    """ Writes the uncompressed asset pack (see ``pack_dir``).
+
+    Returns
+    -------
+
+    list[pathlib.Path]:
+        The files written.
+    """
+
+    pack_dir.mkdir(exist_ok=True)
+    written = []
+
+    for template in (MNI_152_bone_source, MNI_152_source):
+        if not template.exists():
+            logging.warning(f"Template {template} missing; not packed")
+            continue
+
+        path = pack_dir / template.name.replace(".nii.gz", ".nii")
+        nib.save(nib.load(template), path)
+        written.append(path)
+
+    for source in prob_map.values():
+        codes, values = encode(nib.load(source).get_fdata())
+
+        stem = pack_dir / source.name.replace(".nii.gz", "")
+        values_path = stem.with_suffix(".values.npy")
+        codes_path = stem.with_suffix(".codes.npy")
+
+        np.save(values_path, values)
+        np.save(codes_path, codes) # codes last: they mark the map valid
+        written += [values_path, codes_path]
+
+    return written
+
+
+if __name__ == "__main__":
+    '''
+    Usage:
+
+    ./assets.py
+
+    Builds the uncompressed asset pack.
+    '''
+
+    logging.basicConfig(level=logging.INFO)
+
+    for path in build_pack():
+        print(path)
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import pathlib
+import resource
+import socket
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import assets
+import config
+import segmentation as seg
+
+# Batch sizes tried by default
+candidates = (200, 500, 1000, 2000, 5000, 10000)
+
+
+def cache_key(model):
+    """ Key of a tuned setting: host name and hash of the model file.
+    """
+
+    return f"{socket.gethostname()}:{seg.model_hash(model)}"
+
+def load_cache(path=None):
+    path = pathlib.Path(path or config.autotune_cache)
+
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+def save_cache(cache, path=None):
+    path = pathlib.Path(path or config.autotune_cache)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp, path) # atomic, so concurrent runs never read a partial file
+
+def synthetic_stream(n_patches, shape=(256, 256, 12), seed=0):
+    """ Random normalized scan with (at least) n_patches patch positions.
+
+    Returns the patch view, offsets and positions, as used by ``seg.predict``.
+    """
+
+    rng = np.random.default_rng(seed)
+    image2 = rng.random(shape, dtype=np.float32)
+
+    positions = seg.find_centers(np.ones(shape, dtype=bool))
+    positions = np.resize(positions, (n_patches, 3)) # repeats positions if the scan is too small
+
+    volume, view = seg.patch_volume(image2)
+    offsets = seg.patch_offsets(shape, positions)
+
+    return volume, view, offsets, positions
+
+def benchmark(batch_size, model=None, n_patches=20000, session_options=None, prefetch=False):
+    """ Measures throughput of ``seg.predict`` with the given batch size.
+
+    Meant to run in a fresh process (see ``tune``), so that the peak
+    resident set size reflects this batch size only.
+
+    Returns
+    -------
+
+    dict[str, float]:
+        'batch_size', 'patches_per_sec' and 'peak_rss_mb'.
+    """
+
+    volume, view, offsets, positions = synthetic_stream(n_patches)
+    labels = np.zeros(volume.shape[1:] + volume.shape[:1], dtype=np.uint8)
+
+    engine = seg.InferenceEngine(model or assets.model, batch_size, session_options,
+                                 n_buffers=2 if prefetch else 1)
+
+    # Warm-up batch, so session creation and first-run allocations are not timed
+    seg.predict(engine, view, offsets[:batch_size], positions[:batch_size], labels, prefetch=prefetch)
+
+    t = time.perf_counter()
+    seg.predict(engine, view, offsets, positions, labels, prefetch=prefetch)
+    elapsed = time.perf_counter() - t
+
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kilobytes on Linux
+
+    return {'batch_size': batch_size,
+            'patches_per_sec': n_patches / elapsed,
+            'peak_rss_mb': peak_rss_kb / 1024}
+
+def tune(model=None, batch_sizes=candidates, n_patches=20000, max_rss_mb=None,
+         session_options=None, prefetch=False, cache_path=None):
+    """ Finds the fastest batch size for the model on this host, and caches it.
+
+    Each candidate is benchmarked in its own process on a synthetic patch
+    stream. The fastest one whose peak RSS stays under max_rss_mb is saved
+    in the autotune cache, keyed by host and model hash, where
+    ``tuned_batch_size`` (and so later pipeline runs) pick it up.
+
+    Parameters
+    ----------
+
+    model:
+        Path to model to be run (has to be in *.onnx format). Defaults to
+        ``assets.model``.
+
+    batch_sizes:
+        Candidate batch sizes.
+
+    n_patches:
+        Patches per benchmark.
+
+    max_rss_mb:
+        Optional memory limit for the chosen batch size.
+
+    Returns
+    -------
+
+    tuple[int, list[dict]]:
+        Best batch size and the results of all candidates.
+    """
+
+    model = str(model or assets.model)
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for batch_size in batch_sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(benchmark, batch_size, model, n_patches, session_options, prefetch).result()
+
+        logging.info(f"Batch size {batch_size}: {result['patches_per_sec']:.0f} patches/s, "
+                     f"peak RSS {result['peak_rss_mb']:.0f} MB")
+        results.append(result)
+
+    allowed = [r for r in results if max_rss_mb is None or r['peak_rss_mb'] <= max_rss_mb]
+    if not allowed:
+        raise ValueError(f"No batch size stays under {max_rss_mb} MB")
+
+    best = max(allowed, key=lambda r: r['patches_per_sec'])
+
+    cache = load_cache(cache_path)
+    cache[cache_key(model)] = {**best, 'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    save_cache(cache, cache_path)
+
+    return best['batch_size'], results
+
+def tuned_batch_size(model=None, default=None, cache_path=None):
+    """ Batch size saved by ``tune`` for this host and model, or default if not tuned.
+    """
+
+    entry = load_cache(cache_path).get(cache_key(model or assets.model))
+
+    return default if entry is None else entry['batch_size']
+
+
+if __name__ == "__main__":
+    '''
+    Usage:
+
+    ./autotune.py [ MODEL_PATH ] [ BATCH_SIZE ... ]
+
+    Benchmarks the candidate batch sizes (the defaults if none are given) and
+    saves the fastest one for this host and model.
+    '''
+
+    logging.basicConfig(level=logging.INFO)
+
+    model = sys.argv[1] if len(sys.argv) > 1 else None
+    batch_sizes = [int(b) for b in sys.argv[2:]] or candidates
+
+    best, results = tune(model, batch_sizes)
+
+    for r in results:
+        print(f"{r['batch_size']:>6} {r['patches_per_sec']:>10.0f} patches/s {r['peak_rss_mb']:>8.0f} MB")
+    print("Best batch size:", best)
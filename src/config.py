@@ -0,0 +1,86 @@
+import os
+import pathlib
+
+# PIPELINE SETTINGS
+# Every setting can be overridden through the environment variable of the
+# same name prefixed with NPH_ (e.g. NPH_ORT_INTRA_OP_THREADS=8).
+
+def env(name, default, cast=str):
+    value = os.environ.get("NPH_" + name)
+
+    return default if value is None else cast(value)
+
+def flag(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+# ONNX RUNTIME SESSION OPTIONS
+# Thread counts of 0 let ONNX Runtime pick (one thread per physical core).
+# execution_mode is one of 'sequential' or 'parallel', and
+# graph_optimization_level one of 'disable', 'basic', 'extended' or 'all'.
+ort_options = {'intra_op_threads'         : env('ORT_INTRA_OP_THREADS', 0, int),
+               'inter_op_threads'         : env('ORT_INTER_OP_THREADS', 0, int),
+               'execution_mode'           : env('ORT_EXECUTION_MODE', 'sequential'),
+               'graph_optimization_level' : env('ORT_GRAPH_OPTIMIZATION_LEVEL', 'all'),
+              }
+
+# VOLUMES
+# Floating point type the stages load and process scans in. float32 halves
+# the memory of every volume; float64 matches the original pipeline exactly.
+volume_dtype = 'float32' if env('FLOAT32', False, flag) else 'float64'
+
+# REGISTRATION
+# FLIRT matrices found by registration.CT_to_MNI are cached here, keyed by
+# the scan, template and FLIRT parameters, so reprocessing a scan skips
+# registration. At most registration_cache_size matrices are kept (least
+# recently used are evicted); 0 disables the cache.
+registration_cache = env('REGISTRATION_CACHE', pathlib.Path.home() / ".cache" / "nph_pipeline" / "registration", pathlib.Path)
+registration_cache_size = env('REGISTRATION_CACHE_SIZE', 256, int)
+
+# Backend applying (and inverting) registration matrices: 'fsl' (applyxfm and
+# invxfm) or 'native' (in-process NumPy/SciPy resampling, see
+# registration.resample).
+registration_backend = env('REGISTRATION_BACKEND', 'fsl')
+
+# Memory (bytes) the native backend may keep in cached nearest-neighbour
+# gather maps (see registration.gather_map); run_module also drops them
+# after every scan.
+gather_map_bytes = env('GATHER_MAP_BYTES', 512 * 2**20, int)
+
+# Engine finding the CT to MNI matrix: 'flirt' (FSL) or 'native' (in-process
+# 12-DOF registration, see registration.register). With both set to 'native'
+# the pipeline runs without FSL.
+registration_engine = env('REGISTRATION_ENGINE', 'flirt')
+
+# INFERENCE
+# Patches per model call. 'auto' uses the batch size tuned for this host and
+# model by autotune.py, falling back to default_batch_size.
+batch_size = env('BATCH_SIZE', 'auto', lambda v: v if v == 'auto' else int(v))
+default_batch_size = 5000
+model_variant = env('MODEL_VARIANT', 'fp32') # 'fp32' or 'int8' (see quantize.py)
+# Optional cap (bytes) on the float32 batch buffer of the model input; the
+# batch size is reduced to fit. Unset for no cap.
+max_patch_bytes = env('MAX_PATCH_BYTES', None, int)
+autotune_cache = env('AUTOTUNE_CACHE', pathlib.Path.home() / ".cache" / "nph_pipeline" / "autotune.json", pathlib.Path)
+
+# Number of processes the slices of a scan are sharded across (see
+# segmentation.inference).
+inference_workers = env('INFERENCE_WORKERS', 1, int)
+
+# SLICE-PARALLEL POSTPROCESSING
+# The noise reduction of segmentation.inference and postprocess.correct work
+# slice by slice, so slabs of slices can be spread over a pool of workers
+# (see parallel.map_slices). executor is 'thread' or 'process', and chunk the
+# number of slices per slab (0 picks about 4 slabs per worker).
+slice_options = {'workers'  : env('SLICE_WORKERS', 1, int),
+                 'chunk'    : env('SLICE_CHUNK', 0, int),
+                 'executor' : env('SLICE_EXECUTOR', 'thread'),
+                }
+
+# '2d' connects islands and components within a slice only (the original
+# behaviour); '3d' also across slices, which forgoes slice parallelism.
+connectivity = env('CONNECTIVITY', '2d')
+
+# OUTPUTS
+# Save the per-class probabilities of the model (float16, .npy) next to the
+# segmented scan, for QA.
+save_probabilities = env('SAVE_PROBABILITIES', False, flag)
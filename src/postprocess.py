@@ -2,23 +2,121 @@ import nibabel as nib
 import numpy as np
 import os
 import skimage
-import copy
-from assets import prob_map
+from scipy import ndimage
+import assets
+import parallel
 
-ventr_prob_img_data      = nib.load(prob_map['ventr']).get_fdata()
-sub_prob_img_data        = nib.load(prob_map['sub']).get_fdata()
-cerebellum_prob_img_data = nib.load(prob_map['cereb']).get_fdata()
-fourth_prob_img_data     = nib.load(prob_map['4ventr']).get_fdata()
-background_prob_img_data = nib.load(prob_map['background']).get_fdata()
 
+# 8-connectivity within a slice, none across slices (as skimage.measure.label on each slice)
+SLICE_CONNECTIVITY = np.zeros((3, 3, 3), dtype=bool)
+SLICE_CONNECTIVITY[..., 1] = True
 
-def correct(img):
+# Ventricle components per connectivity ('3d' is full 26-connectivity)
+COMPONENT_CONNECTIVITY = {'2d': SLICE_CONNECTIVITY,
+                          '3d': np.ones((3, 3, 3), dtype=bool),
+                         }
+
+
+def correct_labels(labels, sub_prob, ventr_prob, min_size=600, connectivity='2d'):
+    """ Relabels small ventricle components that look subarachnoid, and fills the ventricle prior.
+
+    Per slice, every connected ventricle (class 1) component smaller than
+    min_size voxels, whose mean subarachnoid probability is at least its
+    mean ventricle probability, becomes class 3. As in the original loop,
+    the non-ventricle voxels of a slice ("component 0") are evaluated the
+    same way. Background voxels where the ventricle probability is positive
+    then become class 1.
+
+    The volume is labelled once; component sizes and probability sums come
+    from ``np.bincount``, and the relabelling from a lookup table. Works on
+    any slab of whole slices.
+
+    With connectivity='3d' components are 26-connected across slices, and
+    "component 0" is the rest of the whole volume; this variant cannot be
+    split into slabs.
+
+    Parameters
+    ----------
+
+    labels: numpy.ndarray
+        uint8 label volume.
+
+    sub_prob, ventr_prob: numpy.ndarray
+        Subarachnoid and ventricle probability maps, matching labels.
+
+    Returns
+    -------
+
+    numpy.ndarray:
+        Corrected labels.
+    """
+
+    ventricle = labels == 1
+    components, count = ndimage.label(ventricle, structure=COMPONENT_CONNECTIVITY[connectivity])
+
+    ids = components[ventricle]
+    sizes = np.bincount(ids, minlength=count+1)
+    sub_sum = np.bincount(ids, weights=sub_prob[ventricle], minlength=count+1)
+    ventr_sum = np.bincount(ids, weights=ventr_prob[ventricle], minlength=count+1)
+
+    # "Component 0" is the rest of each slice (of the volume in 3D)
+    axes = (0, 1) if connectivity == '2d' else None
+    rest = ~ventricle
+    rest_size = rest.sum(axis=axes)
+    rest_sub_sum = np.where(rest, sub_prob, 0).sum(axis=axes)
+    rest_ventr_sum = np.where(rest, ventr_prob, 0).sum(axis=axes)
+
+    with np.errstate(divide='ignore', invalid='ignore'): # empty components never qualify
+        relabel = (sizes < min_size) & (sub_sum / sizes >= ventr_sum / sizes)
+        relabel_rest = (rest_size < min_size) & (rest_sub_sum / rest_size >= rest_ventr_sum / rest_size)
+    relabel[0] = False
+
+    corrected = labels.copy()
+    corrected[relabel[components] | (rest & relabel_rest)] = 3
+    corrected[(ventr_prob > 0) & (corrected == 0)] = 1
+
+    return corrected
+
+def correct(img, reference=False, connectivity='2d', slice_options=None):
     """ Intakes segmented image and corrects it (post-processing).
+
+    Labels are rounded to the nearest class and processed, and returned,
+    as uint8. See ``correct_labels`` for the corrections; reference=True
+    runs the original per-component loop instead (slow), e.g. to check
+    equivalence.
+
+    With 2D connectivity the slices can be corrected in parallel; slice_options
+    holds the workers, chunk and executor (see ``parallel.map_slices``).
     """
 
-    img_data = np.round(img.get_fdata())
+    img_data = np.asanyarray(img.dataobj) # integer on-disk labels are read without a float copy
+    if not np.issubdtype(img_data.dtype, np.integer):
+        img_data = np.round(img_data)
+    img_data = img_data.astype(np.uint8)
+
+    if reference:
+        post_processed_img = correct_reference(img_data)
+    else:
+        options = dict(slice_options or {})
+        if connectivity != '2d':
+            options['workers'] = 1 # components span slices
+
+        sub_prob = assets.load_prob_map('sub')
+        ventr_prob = assets.load_prob_map('ventr')
+        post_processed_img = parallel.map_slices(correct_labels, [img_data, sub_prob, ventr_prob],
+                                                 np.uint8, connectivity=connectivity, **options)
+
+    header = img.header.copy()
+    header.set_data_dtype(np.uint8)
+    post_processed = nib.Nifti1Image(post_processed_img, img.affine, header)
+
+    return post_processed
+
+def correct_reference(img_data):
     #print(np.unique(img_data))
-    post_processed_img = copy.deepcopy(img_data)
+    sub_prob_img_data = assets.load_prob_map('sub')
+    ventr_prob_img_data = assets.load_prob_map('ventr')
+    post_processed_img = img_data.copy()
     ventr_correction = np.where(
                         img_data == 1,
                         1,
@@ -34,6 +132,5 @@ def correct(img):
                 post_processed_img[:,:,k] = np.where((labeled_image == i) & (sub_prob_img_data_sum>=ventr_prob_img_data_sum), 3, post_processed_img[:,:,k])
 
     post_processed_img = np.where((ventr_prob_img_data >0)&(post_processed_img ==0),1, post_processed_img)
-    post_processed = nib.Nifti1Image(np.array(post_processed_img), img.affine, img.header)
 
-    return post_processed
+    return post_processed_img
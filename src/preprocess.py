@@ -1,12 +1,11 @@
 import nibabel as nib
 import numpy as np
 import os
-from assets import prob_map
+import assets
+import config
 
-mask = nib.load(prob_map['background']).get_fdata()
 
-
-def skullstrip(scan):
+def skullstrip(scan, dtype=None):
     """ Performs skull stripping on provided scan (in MNI space), using a probability map for the background.
 
     Parameters
@@ -15,6 +14,10 @@ def skullstrip(scan):
     scan: nibabel.nift1.Nifti1Image
         Raw scan that is to be skull stripped. Expected to be in MNI space.
 
+    dtype:
+        Floating point type to process the scan in (defaults to
+        ``config.volume_dtype``).
+
     Returns
     -------
 
@@ -24,22 +27,18 @@ def skullstrip(scan):
         and are not of the background.
     """
 
-    scan_data = scan.get_fdata().copy()
+    scan_data = scan.get_fdata(dtype=dtype or config.volume_dtype).copy() # get_fdata caches; don't modify its array
 
     # Apply MNI mask
-    scan_data[mask >= 0.3] = 0 
-
-    mask_ret = scan_data.copy()
+    scan_data[assets.load_prob_map('background') >= 0.3] = 0 
 
     # Generate binary mask
-
-    mask_ret[mask_ret <= 0] = 0
-    mask_ret[mask_ret > 0] = 1
+    mask_ret = (scan_data > 0).astype(np.float32)
 
     header = scan.header
 
     #affine = np.eye(4)
-    nii_image = nib.Nifti1Image(scan_data.astype(np.float32), affine=None, header=header)
-    nii_mask_image = nib.Nifti1Image(mask_ret.astype(np.float32), affine=None, header=header)
+    nii_image = nib.Nifti1Image(scan_data.astype(np.float32, copy=False), affine=None, header=header)
+    nii_mask_image = nib.Nifti1Image(mask_ret, affine=None, header=header)
 
     return nii_image, nii_mask_image
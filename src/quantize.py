@@ -0,0 +1,179 @@
+import json
+import logging
+import pathlib
+import sys
+
+import nibabel as nib
+import numpy as np
+
+import assets
+import segmentation as seg
+
+# Smallest label agreement with the float model for the INT8 variant to be used
+min_agreement = 0.99
+
+
+def quantize(model=None, output=None, force=False, op_types=None):
+    """ Produces the INT8 dynamically quantized variant of the model.
+
+    The result is cached: it is only regenerated when forced, or when the
+    float model changed since (per the record written by ``approve``).
+
+    Parameters
+    ----------
+
+    model:
+        Path to the float model. Defaults to ``assets.model``.
+
+    output:
+        Path of the quantized model. Defaults to ``assets.model_int8``.
+
+    op_types:
+        Operator types to quantize (e.g. ['MatMul', 'Gemm']); None for all
+        supported ones.
+
+    Returns
+    -------
+
+    pathlib.Path:
+        Path of the quantized model.
+    """
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    model = pathlib.Path(model or assets.model)
+    output = pathlib.Path(output or assets.model_int8)
+
+    record = load_record(output)
+    if output.exists() and not force and record.get('source_hash') == seg.model_hash(model):
+        return output
+
+    logging.info(f"Quantizing {model} to {output}")
+    quantize_dynamic(str(model), str(output), op_types_to_quantize=op_types, weight_type=QuantType.QInt8)
+
+    return output
+
+def record_path(model_int8):
+    return pathlib.Path(model_int8).with_suffix(".json")
+
+def load_record(model_int8=None):
+    path = record_path(model_int8 or assets.model_int8)
+
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+def label_agreement(reference, candidate, volumes, batch_size=5000):
+    """ Fraction of brain voxels on which two models predict the same label.
+
+    Parameters
+    ----------
+
+    reference, candidate:
+        Paths of the two models.
+
+    volumes: Iterable[tuple[nibabel.nifti1.Nifti1Image, nibabel.nifti1.Nifti1Image]]
+        Skull-stripped scans and their masks (as passed to ``seg.inference``).
+
+    Returns
+    -------
+
+    float:
+        Agreement over the mask voxels of all volumes.
+    """
+
+    agree, total = 0, 0
+
+    for image, mask in volumes:
+        a = np.asarray(seg.inference(image, mask, model=reference, batch_size=batch_size).dataobj)
+        b = np.asarray(seg.inference(image, mask, model=candidate, batch_size=batch_size).dataobj)
+        brain = mask.get_fdata() != 0
+
+        agree += np.count_nonzero((a == b) & brain)
+        total += np.count_nonzero(brain)
+
+    return float(agree / max(total, 1))
+
+def approve(volumes, model=None, threshold=min_agreement, force=False, op_types=None):
+    """ Quantizes the model and checks it against the float model on reference volumes.
+
+    The outcome is recorded next to the quantized model; ``resolve_model``
+    only hands out the INT8 variant if it was approved here.
+
+    Returns
+    -------
+
+    dict:
+        The record: hashes of both models, agreement, threshold and
+        whether the variant was approved.
+    """
+
+    model = pathlib.Path(model or assets.model)
+    output = quantize(model, force=force, op_types=op_types)
+
+    agreement = label_agreement(model, output, volumes)
+    record = {'source_hash': seg.model_hash(model),
+              'int8_hash': seg.model_hash(output),
+              'agreement': agreement,
+              'threshold': threshold,
+              'approved': agreement >= threshold,
+             }
+
+    with open(record_path(output), 'w') as f:
+        json.dump(record, f, indent=2)
+
+    if not record['approved']:
+        logging.warning(f"INT8 model refused: label agreement {agreement:.4f} < {threshold}")
+
+    return record
+
+def resolve_model(variant='fp32'):
+    """ Path of the model to run for the given variant ('fp32' or 'int8').
+
+    The INT8 variant is only used if it was approved for the current float
+    model; otherwise this falls back to the float model with a warning.
+    """
+
+    if variant == 'fp32':
+        return assets.model
+
+    if variant != 'int8':
+        raise ValueError(f"Unknown model variant: {variant}")
+
+    record = load_record()
+
+    if not assets.model_int8.exists() or not record.get('approved'):
+        logging.warning("INT8 model missing or not approved (run quantize.py); using the float model")
+        return assets.model
+
+    if (record['source_hash'] != seg.model_hash(assets.model)
+            or record['int8_hash'] != seg.model_hash(assets.model_int8)):
+        logging.warning("INT8 model is out of date (run quantize.py); using the float model")
+        return assets.model
+
+    return assets.model_int8
+
+
+if __name__ == "__main__":
+    '''
+    Usage:
+
+    ./quantize.py { SCAN_PATH } { MASK_PATH } [ SCAN_PATH MASK_PATH ... ]
+
+    Quantizes the bundled model and approves it if its labels agree with the
+    float model on at least min_agreement of the brain voxels of the given
+    (skull-stripped, subject space) scans.
+    '''
+
+    logging.basicConfig(level=logging.INFO)
+
+    paths = sys.argv[1:]
+    assert paths and len(paths) % 2 == 0
+
+    volumes = [(nib.load(scan), nib.load(mask)) for scan, mask in zip(paths[::2], paths[1::2])]
+    record = approve(volumes)
+
+    print(json.dumps(record, indent=2))
+    sys.exit(0 if record['approved'] else 1)
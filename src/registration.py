@@ -1,13 +1,71 @@
 import sys
 import os
+import hashlib
+import json
+import logging
 import numpy as np
 import pathlib
-import fsl.wrappers as fl
+import threading
 import nibabel as nib
+from scipy import ndimage, optimize
 
+import config
 from assets import MNI_152_bone, MNI_152
 
-def basic_skullstrip(ct_img):
+# fslpy (and FSL) is only needed by the 'fsl' backend and the 'flirt' engine
+try:
+    import fsl.wrappers as fl
+    LOAD = fl.LOAD
+except ImportError:
+    fl = None
+    LOAD = object() # stands in for fl.LOAD: results are returned in memory
+
+# FLIRT parameters of CT_to_MNI (part of the registration cache key)
+FLIRT_PARAMS = {'bins'     : 256,
+                'searchrx' : (-180, 180),
+                'searchry' : (-180, 180),
+                'searchrz' : (-180, 180),
+                'dof'      : 12,
+                'interp'   : 'trilinear',
+               }
+
+# Settings of the native registration engine of CT_to_MNI (see register),
+# also part of the registration cache key
+NATIVE_PARAMS = {'levels'        : ((8, 7), (4, 9), (2, 12)),
+                 'bins'          : 64,
+                 'search_angles' : (-30, 0, 30),
+                 'max_points'    : 50000,
+                }
+
+# Registration engines of CT_to_MNI: FSL flirt, or register below
+ENGINES = ('flirt', 'native')
+
+# Resampling backends: FSL applyxfm/invxfm, or the in-process one below
+BACKENDS = ('fsl', 'native')
+
+# Spline order of scipy.ndimage per FSL interpolation method
+INTERPOLATION_ORDERS = {'nearestneighbour' : 0,
+                        'trilinear'        : 1,
+                       }
+
+# Reference grids of MNI_to_CT, by scan geometry (see reference_grid)
+reference_grids = {}
+reference_grids_lock = threading.Lock()
+max_reference_grids = 16
+
+# Nearest-neighbour gather maps, by source and reference geometry and matrix
+# (see gather_map), bounded by config.gather_map_bytes
+gather_maps = {}
+gather_maps_lock = threading.Lock()
+
+# Content hashes of template files, memoized by (path, mtime, size)
+template_hashes = {}
+template_hashes_lock = threading.Lock()
+
+# CT values (HU) above which voxels count as bone (see basic_skullstrip, basic_bone)
+BONE_THRESHOLD = 500
+
+def basic_skullstrip(ct_img, dtype=None):
     """ Eliminate the bone of the CT scan based on hard thresholding of pixel value.
 
     Parameters
@@ -16,6 +74,10 @@ def basic_skullstrip(ct_img):
     ct_img: nibabel.nifti1.Nifti1Image
         The raw scan.
 
+    dtype:
+        Floating point type to process the scan in (defaults to
+        ``config.volume_dtype``).
+
     Returns
     ------
 
@@ -24,23 +86,649 @@ def basic_skullstrip(ct_img):
 
     """
     
-    ct_img_data = ct_img.get_fdata()
+    ct_img_data = ct_img.get_fdata(dtype=dtype or config.volume_dtype)
 
     #print("min = ", np.amin(ct_img_data))
     #print("max = ", np.amax(ct_img_data))
 
-    brain_regions = np.zeros_like(ct_img_data)
-
-    bone_pixel_threshold = 500 # bone pixel threshold
-
-    brain_mask = ct_img_data <= bone_pixel_threshold # brain only regions (no bone)
-    brain_regions[brain_mask] = ct_img_data[brain_mask]
+    brain_mask = ct_img_data <= BONE_THRESHOLD # brain only regions (no bone)
+    brain_regions = np.where(brain_mask, ct_img_data, 0).astype(ct_img_data.dtype, copy=False)
 
     output = nib.Nifti1Image(brain_regions, ct_img.affine, ct_img.header) # preserve all other info of scan
 
     return output
 
-def MNI_to_CT(MNI_scan, ct_scan, affine_mtx=None, res_path=fl.LOAD, inv_path=fl.LOAD, reuse=None):
+def basic_bone(ct_img, dtype=None):
+    """ Keeps only the bone of the CT scan: the voxels ``basic_skullstrip`` removes.
+
+    This is what the native engine registers to ``MNI_152_bone``, which
+    holds nothing but the skull.
+
+    Parameters
+    ----------
+
+    ct_img: nibabel.nifti1.Nifti1Image
+        The raw scan.
+
+    dtype:
+        Floating point type to process the scan in (defaults to
+        ``config.volume_dtype``).
+
+    Returns
+    -------
+
+    nibabel.nifti1.Nifti1Image:
+        The bone of the scan, 0 elsewhere.
+    """
+
+    ct_img_data = ct_img.get_fdata(dtype=dtype or config.volume_dtype)
+    bone = np.where(ct_img_data > BONE_THRESHOLD, ct_img_data, 0).astype(ct_img_data.dtype, copy=False)
+
+    return nib.Nifti1Image(bone, ct_img.affine, ct_img.header)
+
+def geometry(header):
+    """ Hashable summary of the grid of an image: shape, voxel sizes, qform and sform with their codes.
+    """
+
+    forms = []
+    for form, code in (header.get_qform(coded=True), header.get_sform(coded=True)):
+        forms.append((int(code), None if form is None else form.tobytes()))
+
+    return (header.get_data_shape()[:3], header.get_zooms()[:3], *forms)
+
+def image_hash(img):
+    """ SHA-256 of the voxel data and grid (see ``geometry``) of an image.
+    """
+
+    data = np.ascontiguousarray(np.asanyarray(img.dataobj))
+
+    h = hashlib.sha256()
+    h.update(repr((data.shape, data.dtype.str, geometry(img.header))).encode())
+    h.update(data)
+
+    return h.hexdigest()
+
+def template_hash(path):
+    """ ``image_hash`` of a template file, so the packed and compressed versions agree.
+    """
+
+    path = pathlib.Path(path)
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+
+    with template_hashes_lock:
+        if key not in template_hashes:
+            template_hashes[key] = image_hash(nib.load(path))
+
+        return template_hashes[key]
+
+class MatrixCache:
+    """ On-disk cache of the FLIRT matrices found by ``CT_to_MNI``.
+
+    Matrices are stored as FSL .mat text files named after the hash of the
+    registration inputs (see ``key``). A hit refreshes the file's mtime;
+    once more than max_entries are stored, the least recently used ones
+    are evicted. hits and misses count the lookups made through this
+    instance, so callers keep one per process to follow the hit rate.
+
+    Parameters
+    ----------
+
+    directory: pathlib.Path
+        Cache directory. Defaults to ``config.registration_cache``.
+
+    max_entries: int
+        Most matrices kept. Defaults to ``config.registration_cache_size``.
+    """
+
+    def __init__(self, directory=None, max_entries=None):
+        self.directory = pathlib.Path(directory or config.registration_cache)
+        self.max_entries = config.registration_cache_size if max_entries is None else max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image, template, params):
+        """ Hash of everything the matrix depends on: the input image, the template and FLIRT's parameters.
+        """
+
+        h = hashlib.sha256()
+        h.update(image_hash(image).encode())
+        h.update(template_hash(template).encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+
+        return h.hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.mat"
+
+    def get(self, key):
+        """ Cached matrix, or None on a miss.
+        """
+
+        path = self.path(key)
+
+        try:
+            mtx = np.loadtxt(path)
+            os.utime(path) # mark as recently used
+        except (FileNotFoundError, ValueError): # missing or partially written
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return mtx
+
+    def put(self, key, mtx):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        path = self.path(key)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        np.savetxt(tmp, mtx, fmt='%.10f')
+        os.replace(tmp, path) # atomic, so concurrent runs never read a partial file
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob("*.mat"):
+            if len(path.stem) != 64: # not a cache entry
+                continue
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError: # evicted concurrently
+                pass
+
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            path.unlink(missing_ok=True)
+
+def reference_grid(ct_scan):
+    """ Empty image on the grid of ct_scan, as resampling reference of ``MNI_to_CT``.
+
+    FLIRT only reads the geometry of its reference, so this replaces
+    resampling the template into subject space. Grids are built once per
+    geometry and reused.
+
+    Parameters
+    ----------
+
+    ct_scan: nibabel.nifti1.Nifti1Image | pathlib.Path
+        Scan whose grid is wanted (only its header is read).
+
+    Returns
+    -------
+
+    nibabel.nifti1.Nifti1Image:
+        uint8 zero image with the shape, voxel sizes and qform/sform of ct_scan.
+    """
+
+    if not isinstance(ct_scan, nib.Nifti1Image):
+        ct_scan = nib.load(ct_scan) # header only; the voxels are not read
+
+    key = geometry(ct_scan.header)
+
+    with reference_grids_lock:
+        if key not in reference_grids:
+            header = ct_scan.header.copy()
+            header.set_data_shape(key[0])
+            header.set_data_dtype(np.uint8)
+
+            if len(reference_grids) >= max_reference_grids:
+                reference_grids.pop(next(iter(reference_grids))) # oldest first
+            reference_grids[key] = nib.Nifti1Image(np.zeros(key[0], dtype=np.uint8), ct_scan.affine, header)
+
+        return reference_grids[key]
+
+def fsl_wrappers():
+    """ The fslpy wrappers, for the FSL backend and engine.
+    """
+
+    if fl is None:
+        raise ImportError("fslpy is not installed: use the 'native' registration backend and engine")
+
+    return fl
+
+def load_image(img):
+    return img if isinstance(img, nib.Nifti1Image) else nib.load(img)
+
+def load_matrix(mtx):
+    return np.loadtxt(mtx) if isinstance(mtx, (str, pathlib.Path)) else np.asarray(mtx, dtype=np.float64)
+
+def fsl_voxels(img):
+    """ Affine from voxel to FSL scaled-voxel coordinates of an image.
+
+    FLIRT matrices act on voxel coordinates scaled by the voxel sizes, with
+    the x axis flipped when the voxel-to-world affine has a positive
+    determinant (neurological storage order).
+    """
+
+    scaling = np.diag([*img.header.get_zooms()[:3], 1.0])
+
+    if np.linalg.det(img.header.get_best_affine()) > 0: # sform, else qform, as FSL
+        flip = np.diag([-1.0, 1.0, 1.0, 1.0])
+        flip[0, 3] = (img.shape[0] - 1) * scaling[0, 0]
+        scaling = flip @ scaling
+
+    return scaling
+
+def flirt_to_voxels(mtx, src, ref):
+    """ Converts a FLIRT matrix (src to ref) to the affine from ref voxels to src voxels.
+
+    This is the mapping resampling needs: every voxel of the output (on
+    the ref grid) is read from the src voxel it maps to.
+    """
+
+    return np.linalg.inv(fsl_voxels(src)) @ np.linalg.inv(mtx) @ fsl_voxels(ref)
+
+class GatherMap:
+    """ Nearest-neighbour resampling with a fixed FLIRT matrix, as a precomputed index map.
+
+    For every voxel of the ref grid, the map holds the flat index of the
+    src voxel it reads (rounding as ``scipy.ndimage`` does with order 0),
+    and a mask of the voxels mapping outside src, which read 0. Once
+    built, resampling any volume on the src grid is a single ``np.take``.
+
+    Parameters
+    ----------
+
+    src, ref: nibabel.nifti1.Nifti1Image
+        Images whose grids are mapped (only their headers are read).
+
+    mtx: numpy.ndarray
+        FLIRT matrix from src to ref.
+    """
+
+    def __init__(self, src, ref, mtx):
+        affine = flirt_to_voxels(mtx, src, ref)
+
+        self.src_shape = tuple(src.shape[:3])
+        self.shape = tuple(ref.shape[:3])
+        self.size = int(np.prod(self.src_shape))
+
+        i, j = np.meshgrid(np.arange(self.shape[0]), np.arange(self.shape[1]), indexing='ij')
+        upper = np.array(self.src_shape)[:, None] - 1
+        self.index = np.empty(self.shape, dtype=np.int32 if self.size < 2**31 else np.intp)
+        self.outside = np.empty(self.shape, dtype=bool)
+
+        for k in range(self.shape[2]): # slice by slice, to bound the coordinate arrays
+            voxels = np.stack([i.ravel(), j.ravel(), np.full(i.size, k)])
+            coords = affine[:3, :3] @ voxels + affine[:3, 3:]
+
+            inside = np.all((coords >= 0) & (coords <= upper), axis=0)
+            nearest = np.floor(coords + 0.5).astype(np.intp)
+
+            self.index[..., k] = np.ravel_multi_index(nearest, self.src_shape, mode='clip').reshape(self.shape[:2])
+            self.outside[..., k] = ~inside.reshape(self.shape[:2])
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.outside.nbytes
+
+    def apply(self, data):
+        """ Resamples data of shape (..., *src_shape) onto the ref grid.
+
+        Leading axes stack volumes, which are all gathered in one call.
+        """
+
+        data = np.asanyarray(data)
+        lead = data.shape[:-3]
+
+        res = np.take(data.reshape(-1, self.size), self.index, axis=1, mode='clip') # outside indices are clipped
+        res[:, self.outside] = 0
+
+        return res.reshape(lead + self.shape)
+
+def gather_map(src, ref, mtx):
+    """ ``GatherMap`` of the given grids and matrix, built once and reused.
+
+    Cached maps are kept under ``config.gather_map_bytes`` in total, oldest
+    evicted first; a map larger than that is not cached.
+    """
+
+    key = (geometry(src.header), geometry(ref.header), np.asarray(mtx, dtype=np.float64).tobytes())
+
+    with gather_maps_lock:
+        if key in gather_maps:
+            return gather_maps[key]
+
+    gathered = GatherMap(src, ref, mtx)
+
+    if gathered.nbytes > config.gather_map_bytes:
+        return gathered # never fits: leave the cached maps alone
+
+    with gather_maps_lock:
+        while gather_maps and sum(m.nbytes for m in gather_maps.values()) + gathered.nbytes > config.gather_map_bytes:
+            gather_maps.pop(next(iter(gather_maps))) # oldest first
+
+        gather_maps[key] = gathered
+
+    return gathered
+
+def clear_caches():
+    """ Drops the cached reference grids and gather maps, e.g. once a scan is done.
+    """
+
+    with reference_grids_lock:
+        reference_grids.clear()
+
+    with gather_maps_lock:
+        gather_maps.clear()
+
+def resample(src, ref, mtx, interp='trilinear'):
+    """ Native equivalent of FSL applyxfm: resamples src onto the grid of ref.
+
+    Parameters
+    ----------
+
+    src, ref: nibabel.nifti1.Nifti1Image
+        Image to resample, and image whose grid (shape and header
+        geometry) the result takes.
+
+    mtx: numpy.ndarray
+        FLIRT matrix from src to ref.
+
+    interp: str
+        'nearestneighbour' or 'trilinear'. Voxels mapping outside src are 0.
+        Nearest-neighbour goes through a cached ``GatherMap``, so later
+        volumes with the same grids and matrix are nearly free.
+
+    Returns
+    -------
+
+    nibabel.nifti1.Nifti1Image:
+        Resampled image, of the data type of src (rounded if integer), as
+        FLIRT does by default.
+    """
+
+    data = np.asanyarray(src.dataobj)
+    dtype = src.get_data_dtype()
+
+    if interp == 'nearestneighbour':
+        res = gather_map(src, ref, mtx).apply(data)
+    else:
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float64)
+
+        affine = flirt_to_voxels(mtx, src, ref)
+        res = ndimage.affine_transform(data, affine[:3, :3], offset=affine[:3, 3], output_shape=ref.shape[:3],
+                                       order=INTERPOLATION_ORDERS[interp], mode='constant', cval=0)
+
+    if np.issubdtype(dtype, np.integer) and interp != 'nearestneighbour':
+        res = np.round(res)
+    res = res.astype(dtype, copy=False)
+
+    header = ref.header.copy()
+    header.set_data_shape(res.shape)
+    header.set_data_dtype(dtype)
+
+    return nib.Nifti1Image(res, ref.affine, header)
+
+def transform(src, ref, mtx, out=LOAD, interp='nearestneighbour', backend='fsl'):
+    """ Resamples src onto the grid of ref with a FLIRT matrix, using the given backend.
+
+    Inputs may be images or paths. If out is a path the result is saved
+    there and the path returned; otherwise the image is returned.
+    """
+
+    if backend == 'fsl':
+        res = fsl_wrappers().applyxfm(src, ref, mtx, out, interp=interp)
+
+        return out if out != LOAD else res['out']
+
+    if backend != 'native':
+        raise ValueError(f"Unknown backend: {backend}")
+
+    res = resample(load_image(src), load_image(ref), load_matrix(mtx), interp)
+
+    if out != LOAD:
+        nib.save(res, out)
+        return out
+
+    return res
+
+def invert(mtx, out=LOAD, backend='fsl'):
+    """ Inverts a FLIRT matrix (as FSL invxfm), saving it to out if it is a path.
+    """
+
+    if backend == 'fsl':
+        inv = fsl_wrappers().invxfm(mtx, omat=out)
+
+        return out if out != LOAD else inv['omat']
+
+    if backend != 'native':
+        raise ValueError(f"Unknown backend: {backend}")
+
+    inv = np.linalg.inv(load_matrix(mtx))
+
+    if out != LOAD:
+        np.savetxt(out, inv, fmt='%.10f')
+        return out
+
+    return inv
+
+def dof_params(x, dof):
+    """ Expands the dof optimized parameters to the full 12 (see ``params_affine``).
+
+    7 degrees of freedom share one scale over the three axes; 6 keep the
+    scales at 1, and fewer than 12 keep the skews at 0.
+    """
+
+    p = np.zeros(12)
+    p[:6] = x[:6]
+
+    if dof == 7:
+        p[6:9] = x[6]
+    elif dof >= 9:
+        p[6:9] = x[6:9]
+
+    if dof == 12:
+        p[9:12] = x[9:12]
+
+    return p
+
+def params_dof(p, dof):
+    """ Inverse of ``dof_params``: the parameters optimized with dof degrees of freedom.
+    """
+
+    if dof == 6:
+        return p[:6].copy()
+    if dof == 7:
+        return np.concatenate([p[:6], [p[6:9].mean()]])
+
+    return p[:dof].copy()
+
+def params_affine(p, center):
+    """ Affine of 12 registration parameters, about center (in mm).
+
+    The parameters are translations (mm), rotations about x, y and z
+    (radians), log scales and xy, xz and yz skews. The affine is
+    R @ S @ K about center, followed by the translation.
+    """
+
+    cx, cy, cz = np.cos(p[3:6])
+    sx, sy, sz = np.sin(p[3:6])
+
+    rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+
+    skew = np.eye(3)
+    skew[0, 1], skew[0, 2], skew[1, 2] = p[9:12]
+
+    linear = rz @ ry @ rx @ np.diag(np.exp(p[6:9])) @ skew
+
+    affine = np.eye(4)
+    affine[:3, :3] = linear
+    affine[:3, 3] = center + p[:3] - linear @ center
+
+    return affine
+
+def center_of_mass(img):
+    """ Intensity-weighted center of the positive voxels of an image, in FSL mm coordinates.
+    """
+
+    data = np.asanyarray(img.dataobj)
+    center = ndimage.center_of_mass(np.where(data > 0, data, 0))
+
+    return (fsl_voxels(img) @ [*center, 1])[:3]
+
+class CorrelationRatio:
+    """ FLIRT's correlation ratio cost of src against ref, at one resolution.
+
+    ref is sampled on a grid of about spacing mm (its positive voxels, at
+    most max_points of them) and binned into bins intensity bins; src is
+    smoothed to the same resolution. For an affine T from ref to src FSL mm
+    coordinates, the cost is the within-bin variance of the src values
+    sampled at T(ref points), over their total variance: 0 when src is a
+    function of ref, 1 when unrelated.
+
+    Parameters
+    ----------
+
+    src, ref: nibabel.nifti1.Nifti1Image
+        Moving and fixed images.
+
+    spacing: float
+        Resolution (mm).
+
+    bins: int
+        Number of intensity bins of ref.
+
+    max_points: int
+        Largest number of ref points sampled.
+
+    rng: numpy.random.Generator
+        Picks the ref points when there are more than max_points.
+    """
+
+    def __init__(self, src, ref, spacing, bins, max_points, rng):
+        ref_data = np.asanyarray(ref.dataobj).astype(np.float32)
+        ref_zooms = np.array(ref.header.get_zooms()[:3])
+        stride = np.maximum(np.round(spacing / ref_zooms).astype(int), 1)
+
+        ref_data = ndimage.gaussian_filter(ref_data, smoothing(spacing, ref_zooms))
+        grid = tuple(slice(0, n, s) for n, s in zip(ref_data.shape, stride))
+        voxels = np.argwhere(np.asanyarray(ref.dataobj)[grid] > 0) * stride
+
+        if len(voxels) > max_points:
+            voxels = voxels[rng.choice(len(voxels), max_points, replace=False)]
+
+        values = ref_data[tuple(voxels.T)]
+        edges = np.linspace(values.min(), values.max(), bins + 1)[1:-1]
+
+        self.bins = bins
+        self.labels = np.digitize(values, edges)
+        self.points = fsl_voxels(ref) @ np.vstack([voxels.T, np.ones(len(voxels))])
+
+        src_zooms = np.array(src.header.get_zooms()[:3])
+        self.src = ndimage.gaussian_filter(np.asanyarray(src.dataobj).astype(np.float32),
+                                           smoothing(spacing, src_zooms))
+        self.src_voxels = np.linalg.inv(fsl_voxels(src))
+        self.upper = np.array(self.src.shape)[:, None] - 1
+
+    def __call__(self, affine):
+        coords = (self.src_voxels @ affine @ self.points)[:3]
+        inside = np.all((coords >= 0) & (coords <= self.upper), axis=0)
+
+        if np.count_nonzero(inside) < 0.1 * len(inside): # too little overlap to judge
+            return 1.0
+
+        values = ndimage.map_coordinates(self.src, coords[:, inside], order=1)
+        labels = self.labels[inside]
+
+        n = np.bincount(labels, minlength=self.bins)
+        total = np.bincount(labels, weights=values, minlength=self.bins)
+        squares = np.bincount(labels, weights=values**2, minlength=self.bins)
+
+        variance = squares.sum() - total.sum()**2 / len(values)
+        if variance <= 0:
+            return 1.0
+
+        used = n > 0
+        within = (squares[used] - total[used]**2 / n[used]).sum()
+
+        return within / variance
+
+def smoothing(spacing, zooms):
+    """ Gaussian sigma (voxels) bringing images with the given voxel sizes to spacing mm resolution.
+    """
+
+    sigma = np.sqrt(np.maximum(spacing**2 - zooms**2, 0)) / 2.355 # FWHM to sigma
+
+    return sigma / zooms
+
+def register(src, ref, levels=((8, 7), (4, 9), (2, 12)), bins=64, search_angles=(-30, 0, 30),
+             max_points=50000, max_evaluations=3000, seed=0):
+    """ Native 12-DOF affine registration of src to ref; in-process alternative to FLIRT.
+
+    Minimizes the correlation ratio (FLIRT's default cost) coarse to fine
+    with Powell's method, starting from aligned centers of mass and the best
+    orientation of a coarse rotation search.
+
+    Parameters
+    ----------
+
+    src, ref: nibabel.nifti1.Nifti1Image
+        Moving and fixed images (e.g. the bone of a scan and the bone
+        template).
+
+    levels: tuple[tuple[float, int], ...]
+        Resolution (mm) and degrees of freedom (6, 7, 9 or 12) per stage.
+
+    bins: int
+        Intensity bins of the correlation ratio.
+
+    search_angles: tuple[float, ...]
+        Rotations (degrees) about each axis tried at the first level.
+
+    max_points: int
+        Largest number of ref points the cost samples per level.
+
+    max_evaluations: int
+        Cost evaluations allowed per level.
+
+    seed: int
+        Seed of the point sampling, so results are reproducible.
+
+    Returns
+    -------
+
+    numpy.ndarray:
+        FLIRT-compatible matrix from src to ref (FSL scaled-voxel mm
+        coordinates), as written by ``flirt -omat``.
+    """
+
+    rng = np.random.default_rng(seed)
+    center = center_of_mass(ref)
+
+    p = np.zeros(12)
+    p[:3] = center_of_mass(src) - center
+
+    for level, (spacing, dof) in enumerate(levels):
+        cost = CorrelationRatio(src, ref, spacing, bins, max_points, rng)
+
+        if level == 0 and search_angles:
+            angles = np.deg2rad(np.array(np.meshgrid(search_angles, search_angles, search_angles)).reshape(3, -1).T)
+            starts = [np.concatenate([p[:3], a, p[6:]]) for a in angles]
+            p = min(starts, key=lambda q: cost(params_affine(q, center)))
+
+        # Initial steps move points about spacing mm (80 mm, about a head's radius, from the center)
+        scale = params_dof(np.repeat([spacing, spacing / 80], [3, 9]), dof)
+
+        def objective(x):
+            return cost(params_affine(dof_params(x * scale, dof), center))
+
+        result = optimize.minimize(objective, params_dof(p, dof) / scale, method='Powell',
+                                   options={'xtol': 1e-2, 'ftol': 1e-5, 'maxfev': max_evaluations})
+
+        p = dof_params(result.x * scale, dof)
+
+        logging.info(f"Registration at {spacing} mm, {dof} DOF: cost {result.fun:.4f} "
+                     f"after {result.nfev} evaluations")
+
+    return np.linalg.inv(params_affine(p, center)) # src to ref, as FLIRT
+
+def MNI_to_CT(MNI_scan, ct_scan, affine_mtx=None, res_path=LOAD, inv_path=LOAD, reuse=None, backend='fsl'):
     """Brings scans in MNI space to subject space.
 
     This requires the segmented scan's raw counterpart scan, as well
@@ -73,6 +761,9 @@ def MNI_to_CT(MNI_scan, ct_scan, affine_mtx=None, res_path=fl.LOAD, inv_path=fl.
         Optionally specify an array to be used for the inverse transformation.
         Use this only if the inverse affine transformation was already computed.
 
+    backend: str
+        'fsl' (FSL applyxfm and invxfm) or 'native' (see ``resample``).
+
     Returns
     -------
 
@@ -85,26 +776,16 @@ def MNI_to_CT(MNI_scan, ct_scan, affine_mtx=None, res_path=fl.LOAD, inv_path=fl.
     if reuse is None:
         assert affine_mtx is not None
 
-        inv_mtx = fl.invxfm(affine_mtx, omat=inv_path) 
-
-        if inv_path != fl.LOAD:
-            inv_mtx = inv_path
-        else:
-            inv_mtx = inv_mtx['omat']
+        inv_mtx = invert(affine_mtx, inv_path, backend)
     else:
         inv_mtx = reuse
 
-    reference = fl.applyxfm(MNI_152, ct_scan, inv_mtx, out=fl.LOAD)['out']
-    res = fl.applyxfm(MNI_scan, reference, inv_mtx, out=res_path, interp='nearestneighbour') 
-
-    if res_path != fl.LOAD:
-        res = res_path
-    else:
-        res = res['out']
+    res = transform(MNI_scan, reference_grid(ct_scan), inv_mtx, res_path, 'nearestneighbour', backend)
 
     return res, inv_mtx
 
-def CT_to_MNI(ct_scan, res_path=fl.LOAD, affine_mtx_path=fl.LOAD, brain_regions=None, apply_transformation=True):
+def CT_to_MNI(ct_scan, res_path=LOAD, affine_mtx_path=LOAD, brain_regions=None, apply_transformation=True,
+              cache=None, backend='fsl', engine='flirt'):
     """ Finds transformation from CT to MNI space.
 
     Parameters
@@ -124,58 +805,81 @@ def CT_to_MNI(ct_scan, res_path=fl.LOAD, affine_mtx_path=fl.LOAD, brain_regions=
         as an object.
 
     brain_regions:
-        The brain regions of the scan (no skull). If this is set to
-        None, then a primitive skull-stripping procedure will be performed.
+        The image registered to the template. If this is set to None, it is
+        the brain regions of the scan (no skull, see ``basic_skullstrip``)
+        for engine='flirt', and its bone (see ``basic_bone``) for
+        engine='native'.
 
     apply_transformation:
         Flag for indicating whether derived affine transformation should be
         applied to given scan.
 
+    cache: Optional[MatrixCache]
+        Cache of matrices found before; on a hit registration is skipped.
+
+    backend: str
+        Resampling backend applying the transformation, 'fsl' or 'native'
+        (see ``resample``).
+
+    engine: str
+        Registration engine, 'flirt' (FSL, against ``MNI_152``) or 'native'
+        (see ``register``, against ``MNI_152_bone``). With engine='native'
+        and backend='native' neither FSL nor fslpy is needed.
+
     Returns
     ----------
 
     tuple[pathlib.Path | nibabel.nifti1.Nifti1Image, numpy.ndarray]:
-        Registered scan, using FSL flirt; numpy array containing matrix used for transformation.
+        Registered scan; numpy array containing matrix used for transformation.
 
     numpy.ndarray:
         Numpy array containing matrix used for transformation.
         
     """
 
-    if brain_regions is None:
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    if brain_regions is None and engine == 'native':
+        brain_regions = basic_bone(ct_scan) # the bone template holds only the skull
+    elif brain_regions is None:
         brain_regions = basic_skullstrip(ct_scan) # improves registration
         # brain_regions = ct_scan # NOTE: Temporarily turned off primitive skull stripping
     else:
         assert isinstance(brain_regions, nib.Nifti1Image)
 
-    mtx = fl.flirt(src=brain_regions, ref=MNI_152, omat=affine_mtx_path, bins=256, searchrx=(-180,180), searchry=(-180,180), searchrz=(-180,180), dof=12, interp='trilinear')
+    # The native engine registers to the bone template (same grid as MNI_152)
+    template = MNI_152 if engine == 'flirt' else MNI_152_bone
+    params = FLIRT_PARAMS if engine == 'flirt' else {'engine': engine, **NATIVE_PARAMS}
+    key = None if cache is None else cache.key(brain_regions, template, params)
+    mtx = None if cache is None else cache.get(key)
 
-    if affine_mtx_path != fl.LOAD:
-        mtx = affine_mtx_path
-    else:
-        mtx = mtx['omat']
+    if cache is not None:
+        logging.info(f"Registration cache {'miss' if mtx is None else 'hit'} "
+                     f"({cache.hits} hits, {cache.misses} misses)")
 
-    if not apply_transformation: return mtx
+    if mtx is None:
+        if engine == 'flirt':
+            mtx = fsl_wrappers().flirt(src=brain_regions, ref=MNI_152, omat=LOAD, **FLIRT_PARAMS)['omat']
+        else:
+            mtx = register(brain_regions, load_image(template), **NATIVE_PARAMS)
 
-    ct_scan = fl.applyxfm(ct_scan, MNI_152, mtx, res_path, interp='nearestneighbour')
+        if cache is not None:
+            cache.put(key, mtx)
 
-    if res_path != fl.LOAD:
-        ct_scan = res_path
-    else:
-        ct_scan = ct_scan['out']
+    if affine_mtx_path != LOAD:
+        np.savetxt(affine_mtx_path, mtx, fmt='%.10f')
+        mtx = affine_mtx_path
 
-    return ct_scan, mtx
+    if not apply_transformation: return mtx
 
-def apply_affine(scan, affine, res_path=fl.LOAD):
+    ct_scan = transform(ct_scan, MNI_152, mtx, res_path, 'nearestneighbour', backend)
 
-    res = fl.applyxfm(scan, MNI_152, affine, res_path, interp='nearestneighbour')
+    return ct_scan, mtx
 
-    if res_path != fl.LOAD:
-        res = res_path
-    else:
-        res = res['out']
+def apply_affine(scan, affine, res_path=LOAD, backend='fsl'):
 
-    return res
+    return transform(scan, MNI_152, affine, res_path, 'nearestneighbour', backend)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+import logging
+import pathlib
+import shutil
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+import assets
+import registration as reg
+
+# Ranges of the random transformations of the phantoms
+limits = {'translation' : 10,    # mm
+          'rotation'    : 15,    # degrees
+          'scale'       : 0.05,  # log scale
+          'skew'        : 0.03,
+         }
+
+# CT values (HU) of the phantom head; bone spans a range, following the
+# intensities of the bone template
+tissues = {'air'        : -1000,
+           'scalp'      : 40,
+           'brain'      : 35,
+           'ventricles' : 8,
+           'bone'       : (700, 1800),
+          }
+
+# Grid of the phantoms: shape and voxel sizes (mm), CT-like thick slices
+phantom_grid = ((180, 216, 60), (1, 1, 3))
+
+
+def head():
+    """ CT-like head in MNI space, in HU (see ``tissues``).
+
+    The skull is the bone template, with its intensities mapped onto the
+    bone HU range; brain and ventricles come from the probability maps, and
+    a 4 mm layer of scalp surrounds them, in air.
+    """
+
+    template = nib.load(assets.MNI_152_bone)
+    data = template.get_fdata(dtype=np.float32)
+
+    bone = data > 0
+    brain = (assets.load_prob_map('background') < 0.3) & ~bone # as preprocess.skullstrip
+    ventricles = (assets.load_prob_map('ventr') > 0.5) & brain
+
+    hu = np.full(data.shape, tissues['air'], dtype=np.float32)
+    hu[ndimage.binary_dilation(bone | brain, iterations=4)] = tissues['scalp']
+    hu[brain] = tissues['brain']
+    hu[ventricles] = tissues['ventricles']
+    hu[bone] = np.interp(data[bone], [data[bone].min(), data[bone].max()], tissues['bone'])
+
+    return nib.Nifti1Image(hu, template.affine, template.header)
+
+def phantom(head, rng, noise=5):
+    """ Randomly transformed copy of the head, on a CT-like grid.
+
+    Parameters
+    ----------
+
+    head: nibabel.nifti1.Nifti1Image
+        Head (in HU) to transform, as from ``head``.
+
+    rng: numpy.random.Generator
+        Source of the transformation (within ``limits``) and noise.
+
+    noise: float
+        Standard deviation (HU) of added Gaussian noise.
+
+    Returns
+    -------
+
+    tuple[nibabel.nifti1.Nifti1Image, numpy.ndarray]:
+        The phantom, and the true FLIRT matrix from MNI space to phantom.
+    """
+
+    p = np.concatenate([rng.uniform(-1, 1, 3) * limits['translation'],
+                        np.deg2rad(rng.uniform(-1, 1, 3) * limits['rotation']),
+                        rng.uniform(-1, 1, 3) * limits['scale'],
+                        rng.uniform(-1, 1, 3) * limits['skew']])
+    true = reg.params_affine(p, reg.center_of_mass(head))
+
+    shape, zooms = phantom_grid
+    grid = nib.Nifti1Image(np.zeros(shape, dtype=np.float32), np.diag([-zooms[0], zooms[1], zooms[2], 1]))
+
+    # Shifted so that voxels outside the head's grid read as air, not 0
+    shifted = nib.Nifti1Image(np.asanyarray(head.dataobj) - tissues['air'], head.affine, head.header)
+    data = np.asanyarray(reg.resample(shifted, grid, true, 'trilinear').dataobj) + tissues['air']
+    data = data + rng.normal(0, noise, data.shape).astype(np.float32)
+
+    return nib.Nifti1Image(data, grid.affine), true
+
+def displacement(mtx, true, template):
+    """ Registration error of mtx (phantom to MNI) given the true MNI to phantom matrix.
+
+    Returns the RMS and largest displacement (mm) of the template's
+    positive voxels mapped to the phantom and back.
+    """
+
+    voxels = np.argwhere(np.asanyarray(template.dataobj) > 0)
+    points = reg.fsl_voxels(template) @ np.vstack([voxels.T, np.ones(len(voxels))])
+
+    error = np.linalg.norm(((mtx @ true - np.eye(4)) @ points)[:3], axis=0)
+
+    return np.sqrt(np.mean(error**2)), error.max()
+
+def benchmark(n_phantoms=5, seed=0, engines=None, noise=5):
+    """ Times the registration engines of ``CT_to_MNI`` on random phantoms and measures their accuracy.
+
+    Each phantom goes through ``CT_to_MNI`` as a scan would, so every engine
+    registers it with its own preprocessing and against its own template.
+    All engines get the same phantoms.
+
+    Parameters
+    ----------
+
+    n_phantoms: int
+        Number of phantoms.
+
+    engines: Optional[list[str]]
+        Engines to compare; by default 'native', and 'flirt' if FSL, fslpy
+        and ``assets.MNI_152`` are available.
+
+    noise: float
+        Noise of the phantoms (HU, see ``phantom``).
+
+    Returns
+    -------
+
+    list[dict]:
+        Per phantom and engine: 'phantom', 'engine', 'seconds', 'rms_mm'
+        and 'max_mm'.
+    """
+
+    if engines is None:
+        flirt = shutil.which('flirt') and reg.fl is not None and pathlib.Path(assets.MNI_152).exists()
+        engines = ['native'] + (['flirt'] if flirt else [])
+
+    template = nib.load(assets.MNI_152_bone) # same grid as MNI_152
+    mni_head = head()
+
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for i in range(n_phantoms):
+        src, true = phantom(mni_head, rng, noise)
+
+        for engine in engines:
+            t = time.perf_counter()
+            mtx = reg.CT_to_MNI(src, apply_transformation=False, engine=engine)
+            seconds = time.perf_counter() - t
+
+            rms, largest = displacement(mtx, true, template)
+            results.append({'phantom': i, 'engine': engine, 'seconds': seconds, 'rms_mm': rms, 'max_mm': largest})
+
+            logging.info(f"Phantom {i}, {engine}: {seconds:.1f}s, RMS error {rms:.2f} mm (max {largest:.2f} mm)")
+
+    return results
+
+
+if __name__ == "__main__":
+    '''
+    Usage:
+
+    ./registration_benchmark.py [ N_PHANTOMS ] [ SEED ]
+
+    Registers randomly transformed CT-like phantoms with CT_to_MNI, using
+    the native engine (and FLIRT, if installed), printing time and error
+    per phantom and engine.
+    '''
+
+    logging.basicConfig(level=logging.WARNING)
+
+    args = [int(a) for a in sys.argv[1:3]]
+    results = benchmark(*args)
+
+    print(f"{'phantom':>7} {'engine':>7} {'seconds':>8} {'rms mm':>7} {'max mm':>7}")
+    for r in results:
+        print(f"{r['phantom']:>7} {r['engine']:>7} {r['seconds']:>8.1f} {r['rms_mm']:>7.2f} {r['max_mm']:>7.2f}")
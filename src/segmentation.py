@@ -2,12 +2,79 @@ import onnxruntime
 import numpy as np
 import nibabel as nib
 import sys
+from scipy import ndimage
 from scipy.special import softmax
 import heapq
+import hashlib
+import multiprocessing
+import os
+import pathlib
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 import assets
+import config
 import logging
+import parallel
+import shared
 
-def eliminateNoise(label, minArea=16):
+# 4-connectivity within a slice, no connectivity across slices
+SLICE_CONNECTIVITY = np.zeros((3, 3, 3), dtype=bool)
+SLICE_CONNECTIVITY[..., 1] = ndimage.generate_binary_structure(2, 1)
+
+# Islands of eliminateNoise per connectivity ('3d' adds the two neighbours across slices)
+NOISE_CONNECTIVITY = {'2d': SLICE_CONNECTIVITY,
+                      '3d': ndimage.generate_binary_structure(3, 1),
+                     }
+
+def eliminateNoise(label, minArea=16, reference=False, connectivity='2d'):
+    """ Relabels small islands of the segmentation as CSF (class 2).
+
+    An island is a 4-connected group of voxels within one slice sharing the
+    same nonzero label. Islands with fewer than minArea voxels become class
+    2, all others keep their label; background stays 0.
+
+    Parameters
+    ----------
+
+    label: numpy.ndarray
+        Segmented volume.
+
+    minArea: int
+        Smallest island area (in voxels) that keeps its label.
+
+    reference:
+        Use the original flood-fill implementation (slow), e.g. to check
+        equivalence.
+
+    connectivity:
+        '2d' (the original islands) or '3d', which also connects voxels to
+        their neighbours in the adjacent slices. 3D islands span slices, so
+        they cannot be processed slab by slab (see ``denoise``).
+
+    Returns
+    -------
+
+    numpy.ndarray:
+        Denoised volume, of the same type as label.
+    """
+
+    if reference:
+        return eliminateNoise_reference(label, minArea=minArea)
+
+    newLabel = np.zeros(label.shape, dtype=label.dtype)
+
+    for value in np.unique(label[label != 0]):
+        islands, _ = ndimage.label(label == value, structure=NOISE_CONNECTIVITY[connectivity])
+        area = np.bincount(islands.ravel())
+
+        region = islands != 0
+        newLabel[region] = np.where(area[islands[region]] < minArea, 2, value)
+
+    return newLabel
+
+def eliminateNoise_reference(label, minArea=16):
     neighbors=[(-1,0),(1,0),(0,-1),(0,1)]
                 
     seen=set()
@@ -58,7 +125,66 @@ def eliminateNoise(label, minArea=16):
     return newLabel
 
 
-def cutoff(label):
+# 8-neighbourhood within a slice, excluding the voxel itself
+SLICE_NEIGHBOURS = np.ones((3, 3, 1), dtype=np.uint8)
+SLICE_NEIGHBOURS[1, 1, 0] = 0
+
+def cutoff(label, reference=False):
+    """ Relabels CSF voxels (class 2) fully surrounded by subarachnoid (class 3).
+
+    A class 2 voxel becomes class 3 when all 8 in-slice neighbours are
+    class 3. Voxels on the slice border have fewer than 8 neighbours and
+    are never relabelled. The given array is modified in place.
+
+    Parameters
+    ----------
+
+    label: numpy.ndarray
+        Segmented volume.
+
+    reference:
+        Use the original per-voxel loop (slow), e.g. to check equivalence.
+
+    Returns
+    -------
+
+    numpy.ndarray:
+        Copy of the relabelled volume.
+    """
+
+    if reference:
+        return cutoff_reference(label)
+
+    # Zero padding means border voxels can count at most 5 neighbours
+    surrounded = ndimage.convolve((label == 3).astype(np.uint8), SLICE_NEIGHBOURS,
+                                  mode='constant', cval=0) == 8
+
+    label[(label == 2) & surrounded] = 3
+
+    return np.array(label)
+
+def denoise(label, minArea=64, connectivity='2d'):
+    """ Noise reduction of the inference output: ``eliminateNoise`` followed by ``cutoff``.
+    """
+
+    return cutoff(eliminateNoise(label, minArea=minArea, connectivity=connectivity))
+
+def parallel_denoise(label, minArea=64, connectivity='2d', slice_options=None):
+    """ Runs ``denoise`` over slabs of slices (see ``parallel.map_slices``).
+
+    slice_options holds the workers, chunk and executor of map_slices.
+    With 3D connectivity islands cross slab borders, so the volume is
+    processed whole.
+    """
+
+    options = dict(slice_options or {})
+    if connectivity != '2d':
+        options['workers'] = 1
+
+    return parallel.map_slices(denoise, [label], label.dtype, minArea=minArea, connectivity=connectivity,
+                               **options)
+
+def cutoff_reference(label):
 
     neighbors=[(1,1,0),(0,1,0),(-1,1,0),(-1,0,0),(-1,-1,0),(0,-1,0),(1,-1,0),(1,0,0)]
     surpos = [3,3,3,3,3,3,3,3]
@@ -84,13 +210,246 @@ def get_center(image, mask, i, j, k):
     
     return sample, center
 
-def patch_generator(image, mask, batch_size='max'):
-    x,y,z = image.shape
-    
+# Offsets of a 2x2 tile (see scatter_tiles)
+TILE_ROWS = np.array([[0], [1]])
+TILE_COLS = np.array([[0, 1]])
+
+def find_centers(mask):
+    """ Finds every valid patch position of the stride-2 grid in one pass.
+
+    A position (i, j, k) is valid when the 2x2 block mask[i:i+2, j:j+2, k]
+    has any nonzero voxel, i.e. the same test as ``get_center(...)[1].any()``.
+
+    Parameters
+    ----------
+
+    mask: numpy.ndarray
+        Mask indicating relevant regions of brain.
+
+    Returns
+    -------
+
+    numpy.ndarray:
+        (N, 3) integer array of (i, j, k) positions, in the same (k, i, j)
+        order as the reference loop in ``patch_generator``.
+    """
+
+    x, y, z = mask.shape
+    ni, nj = len(range(17, x-17, 2)), len(range(17, y-17, 2))
+
+    if ni == 0 or nj == 0 or z < 3:
+        return np.empty((0, 3), dtype=np.intp)
+
+    nonzero = mask[17:17+2*ni, 17:17+2*nj, 1:z-1] != 0
+    blocks = nonzero.reshape(ni, 2, nj, 2, z-2).any(axis=(1, 3))
+
+    k, i, j = np.nonzero(blocks.transpose(2, 0, 1))
+
+    return np.stack((17 + 2*i, 17 + 2*j, 1 + k), axis=1)
+
+# Margins (in voxels) kept around the mask by crop_bounds: a centre can sit one
+# voxel before the mask (its 2x2 block still overlaps it), and needs 16 more
+# voxels for its patch plus one for the grid bounds of find_centers
+CROP_MARGINS = (18, 18, 1)
+
+def crop_bounds(mask):
+    """ Tight bounding box of the mask, grown by the patch margins.
+
+    Running ``find_centers`` on ``mask[crop]`` finds exactly the positions
+    it finds on the whole mask (shifted by the crop start), and their
+    patches lie inside the crop. The x and y starts are even, to keep the
+    stride-2 grid aligned.
+
+    Returns
+    -------
+
+    tuple[slice, slice, slice]:
+        The crop, which covers the whole volume if the mask is empty.
+    """
+
+    crop = []
+
+    for axis, margin in enumerate(CROP_MARGINS):
+        others = tuple(a for a in range(3) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask != 0, axis=others))
+
+        if len(nonzero) == 0:
+            return (slice(None),) * 3
+
+        start = max(nonzero[0] - margin, 0)
+        stop = min(nonzero[-1] + 1 + margin, mask.shape[axis])
+
+        if axis < 2:
+            start -= start % 2
+
+        crop.append(slice(int(start), int(stop)))
+
+    return tuple(crop)
+
+def limit_batch_size(batch_size, max_patch_bytes, itemsize=8):
+    """ Caps batch_size so that a batch of patches fits in max_patch_bytes.
+
+    Parameters
+    ----------
+
+    batch_size: int | 'max'
+        Requested batch size.
+
+    max_patch_bytes: Optional[int]
+        Memory budget for one batch of 33x33x3 patches. None means no cap.
+
+    itemsize: int
+        Bytes per patch voxel (8 for float64 patches, 4 for float32).
+
+    Returns
+    -------
+
+    int | 'max':
+        Batch size to use. 'max' is only returned when there is no cap.
+    """
+
+    if max_patch_bytes is None:
+        return batch_size
+
+    limit = max(int(max_patch_bytes) // (33*33*3*itemsize), 1)
+
+    if batch_size == 'max':
+        return limit
+
+    return min(batch_size, limit)
+
+def gather_patches(image, positions):
+    """ Gathers the 33x33x3 patches centred at the given positions.
+
+    Uses a strided sliding-window view of the image, so the patches are
+    copied out with a single fancy-indexing operation.
+
+    Returns
+    -------
+
+    numpy.ndarray:
+        (N, 33, 33, 3) array, identical to stacking ``get_center(...)[0]``.
+    """
+
+    windows = np.lib.stride_tricks.sliding_window_view(image, (33, 33, 3))
+    i, j, k = positions.T
+
+    return windows[i-16, j-16, k-1]
+
+def normalize(image):
+    """ Clips the scan to [-100, 200] HU and rescales it to [0, 1].
+    """
+
     image2 = np.clip(image, -100, 200)
     image2 += 100
     image2 /= 300
 
+    return image2
+
+def patch_volume(image):
+    """ Lays out the normalized scan for gathering NCHW patches.
+
+    Returns a C-contiguous float32 copy of the image in (z, x, y) order,
+    and a read-only strided view of it with shape (M, 3, 33, 33), in which
+    row L is the patch whose first voxel sits at flat offset L. Patches
+    can then be copied straight into a batch buffer, without an
+    intermediate (N, 33, 33, 3) array (see ``patch_offsets``).
+    """
+
+    volume = np.ascontiguousarray(image.transpose(2, 0, 1), dtype=np.float32)
+
+    return volume, patch_view(volume)
+
+def patch_view(volume):
+    """ Strided (M, 3, 33, 33) patch view of a C-contiguous (z, x, y) volume.
+    """
+
+    z, x, y = volume.shape
+    itemsize = volume.itemsize
+
+    extent = 2*x*y + 32*y + 32 # flat distance from first to last voxel of a patch
+    view = np.lib.stride_tricks.as_strided(volume.reshape(-1),
+                                           shape=(max(volume.size - extent, 0), 3, 33, 33),
+                                           strides=(itemsize, x*y*itemsize, y*itemsize, itemsize),
+                                           writeable=False)
+
+    return view
+
+def patch_offsets(shape, positions):
+    """ Maps (i, j, k) patch centres to rows of the view from ``patch_volume``.
+    """
+
+    x, y, _ = shape
+    i, j, k = positions.T
+
+    return (k-1)*x*y + (i-16)*y + (j-16)
+
+def scatter_tiles(volume, positions, tiles):
+    """ Writes 2x2 tiles into volume[i:i+2, j:j+2, k] for all positions at once.
+
+    Parameters
+    ----------
+
+    volume: numpy.ndarray
+        Volume to write into (in place).
+
+    positions: numpy.ndarray
+        (N, 3) array of (i, j, k) positions, as from ``find_centers``.
+
+    tiles: numpy.ndarray
+        (N, 2, 2) array (or anything broadcasting to it) of values.
+    """
+
+    i, j, k = (positions.T)[..., None, None]
+    volume[i + TILE_ROWS, j + TILE_COLS, k] = tiles
+
+def patch_generator(image, mask, batch_size='max', vectorized=True, max_patch_bytes=None):
+    """ Yields batches of normalized 33x33x3 patches centred on the mask.
+
+    Parameters
+    ----------
+
+    image: numpy.ndarray
+        Raw scan.
+
+    mask: numpy.ndarray
+        Mask indicating relevant regions of brain.
+
+    batch_size: int | 'max'
+        Number of patches per batch; 'max' puts all patches in one batch.
+
+    vectorized:
+        Use the array-based candidate search and gathering. False runs the
+        original per-position loop.
+
+    max_patch_bytes: Optional[int]
+        Cap on the memory held by one batch of patches; batch_size is
+        reduced to fit. With batch_size='max' this sets the batch size.
+
+    Yields
+    ------
+
+    tuple[numpy.ndarray, numpy.ndarray | list]:
+        (N, 33, 33, 3) patches and their (i, j, k) positions.
+    """
+
+    x,y,z = image.shape
+    
+    image2 = normalize(image)
+    batch_size = limit_batch_size(batch_size, max_patch_bytes, image2.itemsize)
+
+    if vectorized:
+        positions = find_centers(mask)
+
+        if batch_size == 'max':
+            batch_size = max(len(positions), 1)
+
+        for start in range(0, len(positions), batch_size):
+            b = positions[start:start+batch_size]
+            yield gather_patches(image2, b), b
+
+        return
+
     positions = []
 
     for k in range(1, z-1, 1):
@@ -114,7 +473,516 @@ def patch_generator(image, mask, batch_size='max'):
         yield np.array(samples), b
 
 
-def inference(image, mask, model=None, batch_size=200):
+EXECUTION_MODES = {'sequential' : onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+                   'parallel'   : onnxruntime.ExecutionMode.ORT_PARALLEL,
+                  }
+
+OPTIMIZATION_LEVELS = {'disable'  : onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                       'basic'    : onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                       'extended' : onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                       'all'      : onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+                      }
+
+# Process-wide caches, keyed as described in get_session / model_hash
+sessions = {}
+model_hashes = {}
+sessions_lock = threading.Lock()
+
+def model_hash(model):
+    """ SHA-256 of the model file, recomputed only when the file changes.
+    """
+
+    path = pathlib.Path(model).resolve()
+    stat = path.stat()
+    key = (path, stat.st_mtime_ns, stat.st_size)
+
+    if key not in model_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        model_hashes[key] = digest.hexdigest()
+
+    return model_hashes[key]
+
+def session_options(intra_op_threads=0, inter_op_threads=0,
+                    execution_mode='sequential', graph_optimization_level='all'):
+    """ Builds onnxruntime.SessionOptions from plain settings (see config.ort_options).
+    """
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = EXECUTION_MODES[execution_mode]
+    options.graph_optimization_level = OPTIMIZATION_LEVELS[graph_optimization_level]
+
+    return options
+
+def get_session(model=None, **options):
+    """ Returns a shared onnxruntime.InferenceSession for the given model.
+
+    Sessions are cached once per process, keyed by the model path, the hash
+    of the model file and the session options, so repeated calls (e.g. in
+    batch or daemon runs) skip model loading and graph optimization.
+
+    Parameters
+    ----------
+
+    model:
+        Path to model to be run (has to be in *.onnx format). Defaults to
+        ``assets.model``.
+
+    **options:
+        Overrides of ``config.ort_options`` (intra_op_threads,
+        inter_op_threads, execution_mode, graph_optimization_level).
+
+    Returns
+    -------
+
+    onnxruntime.InferenceSession:
+        Session for the model.
+    """
+
+    if model is None:
+        model = assets.model
+
+    options = {**config.ort_options, **options}
+    path = str(pathlib.Path(model).resolve())
+    key = (path, model_hash(path), tuple(sorted(options.items())))
+
+    with sessions_lock:
+        if key not in sessions:
+            logging.info(f"Creating ONNX Runtime session for {path} with {options}")
+            sessions[key] = onnxruntime.InferenceSession(path, sess_options=session_options(**options))
+
+        return sessions[key]
+
+
+class InferenceEngine:
+    """ Runs the model over batches of patches without per-batch allocations.
+
+    Patches are written directly into a reused, contiguous float32 input
+    buffer of shape (batch_size, 3, 33, 33), and ONNX Runtime writes its
+    logits into a preallocated output buffer, both bound through
+    ``IOBinding``. Buffers are only rebound when the batch length changes
+    (i.e. for the final, partial batch).
+
+    With several buffers ("slots"), one slot can be filled while the model
+    runs on another (see ``prefetch_batches``). All slots share the output
+    buffer, so runs must not overlap.
+
+    Parameters
+    ----------
+
+    model:
+        Path to model to be run (has to be in *.onnx format).
+
+    batch_size:
+        Maximum number of patches per batch.
+
+    session_options:
+        Overrides of ``config.ort_options`` for the (cached) session.
+
+    n_buffers:
+        Number of input buffers (slots).
+    """
+
+    def __init__(self, model, batch_size, session_options=None, n_buffers=1):
+        self.session = get_session(model, **(session_options or {}))
+        self.batch_size = batch_size
+        self.n_buffers = n_buffers
+
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        n_outputs = self.session.get_outputs()[0].shape[-1]
+
+        self.inputs = [np.empty((batch_size, 3, 33, 33), dtype=np.float32) for _ in range(n_buffers)]
+        self.outputs = np.empty((batch_size, n_outputs), dtype=np.float32)
+
+        self.bindings = [self.session.io_binding() for _ in range(n_buffers)]
+        self.bound = [0] * n_buffers
+
+    def load(self, view, offsets, slot=0):
+        """ Copies the patches at the given rows of ``view`` into an input buffer.
+
+        Returns the number of patches loaded.
+        """
+
+        # Row-wise copies: fancy indexing (or np.take) on the strided view
+        # would materialize a temporary first.
+        inputs = self.inputs[slot]
+        for row, offset in enumerate(offsets.tolist()):
+            inputs[row] = view[offset]
+
+        return len(offsets)
+
+    def run(self, n, slot=0):
+        """ Runs the model on the first n patches of an input buffer.
+
+        Returns a view of the output buffer, which is overwritten by the
+        next call.
+        """
+
+        binding = self.bindings[slot]
+
+        if n != self.bound[slot]:
+            inputs, outputs = self.inputs[slot][:n], self.outputs[:n]
+
+            binding.bind_cpu_input(self.input_name, inputs)
+            binding.bind_output(self.output_name, 'cpu', 0, np.float32,
+                                list(outputs.shape), outputs.ctypes.data)
+            self.bound[slot] = n
+
+        self.session.run_with_iobinding(binding)
+
+        return self.outputs[:n]
+
+
+class UniformShortcut:
+    """ Skips model calls for (nearly) constant patches.
+
+    Patches whose values span at most tolerance (after normalization, so
+    1/300 is 1 HU) are keyed by their mid value, quantized to levels steps
+    over [0, 1]. The model runs once per key, on a constant patch of the
+    quantized value, and its logits are reused for every patch with that
+    key. Only the remaining patches go through the engine.
+
+    Parameters
+    ----------
+
+    tolerance:
+        Largest value range (max - min) of a patch considered constant.
+
+    levels:
+        Quantization steps over [0, 1] for the constant value.
+
+    Attributes
+    ----------
+
+    patches, shortcut_patches, model_calls:
+        Patches seen, patches answered from the cache, and model calls made
+        for new cache entries.
+    """
+
+    def __init__(self, tolerance=2/300, levels=300):
+        self.tolerance = tolerance
+        self.levels = levels
+        self.cache = {}
+
+        self.patches = 0
+        self.shortcut_patches = 0
+        self.model_calls = 0
+
+    def constant_logits(self, engine, key):
+        if key not in self.cache:
+            patch = np.full((1, 3, 33, 33), key / self.levels, dtype=np.float32)
+            self.cache[key] = engine.session.run(None, {engine.input_name: patch})[0][0]
+            self.model_calls += 1
+
+        return self.cache[key]
+
+    def run(self, engine, n, slot=0):
+        """ Drop-in for ``engine.run(n, slot)``.
+
+        Non-constant patches are compacted to the front of the input
+        buffer, which is overwritten.
+
+        Returns
+        -------
+
+        numpy.ndarray:
+            (n, outputs) logits.
+        """
+
+        flat = engine.inputs[slot][:n].reshape(n, -1)
+        lo, hi = flat.min(axis=1), flat.max(axis=1)
+
+        uniform = (hi - lo) <= self.tolerance
+        rest = np.flatnonzero(~uniform)
+
+        logits = np.empty((n, engine.outputs.shape[1]), dtype=np.float32)
+
+        if uniform.any():
+            keys, inverse = np.unique(np.rint((lo[uniform] + hi[uniform]) / 2 * self.levels).astype(np.int64),
+                                      return_inverse=True)
+            table = np.stack([self.constant_logits(engine, key) for key in keys.tolist()])
+            logits[uniform] = table[inverse]
+
+        if len(rest):
+            if len(rest) < n:
+                inputs = engine.inputs[slot]
+                inputs[:len(rest)] = inputs[rest]
+            logits[rest] = engine.run(len(rest), slot)
+
+        self.patches += n
+        self.shortcut_patches += n - len(rest)
+
+        return logits
+
+
+def serial_batches(engine, view, offsets, timings):
+    """ Loads batches into slot 0 of the engine, one after the other.
+
+    Yields
+    ------
+
+    tuple[int, int, int]:
+        (slot, start, n): the batch of offsets[start:start+n] is in the slot.
+    """
+
+    for start in range(0, len(offsets), engine.batch_size):
+        t = time.perf_counter()
+        n = engine.load(view, offsets[start:start+engine.batch_size])
+        elapsed = time.perf_counter() - t
+
+        timings['extract'] += elapsed
+        timings['wait'] += elapsed # nothing else runs during extraction
+
+        yield 0, start, n
+
+def prefetch_batches(engine, view, offsets, timings):
+    """ Loads batches in a background thread, double-buffered through the engine slots.
+
+    A producer thread fills a free slot with batch N+1 while the caller
+    runs the model on batch N; the slot of a batch is handed back once the
+    caller asks for the next one. ONNX Runtime releases the GIL while
+    running, so extraction overlaps with inference.
+
+    Yields
+    ------
+
+    tuple[int, int, int]:
+        (slot, start, n), as in ``serial_batches``.
+    """
+
+    free = queue.Queue()
+    ready = queue.Queue()
+
+    for slot in range(engine.n_buffers):
+        free.put(slot)
+
+    def produce():
+        try:
+            for start in range(0, len(offsets), engine.batch_size):
+                slot = free.get()
+                if slot is None: return # consumer stopped early
+
+                t = time.perf_counter()
+                n = engine.load(view, offsets[start:start+engine.batch_size], slot)
+                timings['extract'] += time.perf_counter() - t
+
+                ready.put((slot, start, n))
+
+            ready.put(None)
+        except BaseException as e:
+            ready.put(e)
+
+    producer = threading.Thread(target=produce, name="patch-prefetch", daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            t = time.perf_counter()
+            item = ready.get()
+            timings['wait'] += time.perf_counter() - t
+
+            if item is None: break
+            if isinstance(item, BaseException): raise item
+
+            yield item
+            free.put(item[0])
+    finally:
+        free.put(None)
+        producer.join()
+
+
+def predict(engine, view, offsets, positions, labels, probability_volume=None, prefetch=False, timings=None,
+            shortcut=None):
+    """ Runs the engine on the patches at the given positions, writing the results in place.
+
+    Parameters
+    ----------
+
+    engine: InferenceEngine
+        Engine to run (needs 2 buffers for prefetching).
+
+    view, offsets:
+        Patch view of the normalized scan and the rows of the patches (see
+        ``patch_volume`` and ``patch_offsets``).
+
+    positions: numpy.ndarray
+        (N, 3) array of the (i, j, k) positions of the patches.
+
+    labels: numpy.ndarray
+        Label volume the predicted classes are written to.
+
+    probability_volume: Optional[numpy.ndarray]
+        (x, y, z, 5) volume the class probabilities are written to.
+
+    prefetch:
+        Extract batches in a background thread (see ``prefetch_batches``).
+
+    timings: Optional[dict]
+        Dict to add the seconds spent per stage to.
+
+    shortcut: Optional[UniformShortcut]
+        Answer constant patches from a cache instead of the model. Its
+        counters are added to the timings as 'patches',
+        'shortcut_patches' and 'model_calls'.
+
+    Returns
+    -------
+
+    dict[str, float]:
+        The timings.
+    """
+
+    if timings is None:
+        timings = {}
+    for stage in ('extract', 'wait', 'run', 'scatter'):
+        timings.setdefault(stage, 0.0)
+
+    batches = (prefetch_batches if prefetch else serial_batches)(engine, view, offsets, timings)
+
+    for slot, start, n in batches:
+        idx = positions[start:start+n]
+
+        # compute ONNX Runtime output prediction
+        t = time.perf_counter()
+        ort_outs = engine.run(n, slot) if shortcut is None else shortcut.run(engine, n, slot)
+        ort_outs = ort_outs.reshape((ort_outs.shape[0], 5, 2, 2))
+        timings['run'] += time.perf_counter() - t
+
+        t = time.perf_counter()
+
+        # softmax is monotonic, so the logits give the same labels
+        pred = np.argmax(ort_outs, axis=1)
+
+        # The first row of each predicted tile fills both rows of the 2x2
+        # block, as in the original per-patch assignment of pred[k,0,...].
+        scatter_tiles(labels, idx, pred[:, :1, :])
+
+        if probability_volume is not None:
+            softmax_out = softmax(ort_outs, axis=1)
+            scatter_tiles(probability_volume, idx, softmax_out[:, :, :1, :].transpose(0, 2, 3, 1))
+
+        timings['scatter'] += time.perf_counter() - t
+
+    if shortcut is not None:
+        timings['patches'] = timings.get('patches', 0) + shortcut.patches
+        timings['shortcut_patches'] = timings.get('shortcut_patches', 0) + shortcut.shortcut_patches
+        timings['model_calls'] = timings.get('model_calls', 0) + shortcut.model_calls
+
+    return timings
+
+def predict_shard(arrays, z_range, model, batch_size, session_options=None, prefetch=False, shortcut=None):
+    """ Worker of ``sharded_predict``: predicts the slabs z_range[0] <= k < z_range[1] in place.
+
+    arrays maps 'volume' (normalized float32 scan in (z, x, y) order),
+    'mask', 'labels' and optionally 'probabilities' to shared memory
+    specs (see ``shared.attach``). The worker keeps its own (cached) ONNX
+    Runtime session. shortcut holds ``UniformShortcut`` settings, if used.
+
+    Returns the timings of the worker.
+    """
+
+    blocks, views = {}, {}
+    for key, spec in arrays.items():
+        blocks[key], views[key] = shared.attach(spec)
+
+    # Arrays backed by the blocks are only referenced through `views`, so
+    # the blocks can be closed once it is cleared.
+    try:
+        k0, k1 = z_range
+
+        # Centres of slice k only depend on mask[..., k]
+        positions = find_centers(views['mask'][..., k0-1:k1+1])
+        positions[:, 2] += k0 - 1
+        offsets = patch_offsets(views['mask'].shape, positions)
+
+        engine = InferenceEngine(model, batch_size, session_options, n_buffers=2 if prefetch else 1)
+
+        return predict(engine, patch_view(views['volume']), offsets, positions, views['labels'],
+                       views.get('probabilities'), prefetch=prefetch,
+                       shortcut=None if shortcut is None else UniformShortcut(**shortcut))
+    finally:
+        views.clear()
+        shared.release(*blocks.values())
+
+def shard_bounds(positions, z, n_shards):
+    """ Splits slices 1 <= k < z-1 into contiguous slabs with similar numbers of patches.
+
+    Returns a list of (start, stop) slice ranges.
+    """
+
+    counts = np.bincount(positions[:, 2], minlength=z)[1:z-1]
+    cumulative = np.cumsum(counts)
+    targets = cumulative[-1] * np.arange(1, n_shards) / n_shards if len(counts) else []
+
+    edges = np.unique(np.concatenate(([0], np.searchsorted(cumulative, targets, side='right'), [len(counts)])))
+
+    return [(int(1 + a), int(1 + b)) for a, b in zip(edges[:-1], edges[1:])]
+
+def sharded_predict(image2, mask, positions, workers, model, batch_size, session_options=None,
+                    prefetch=False, probabilities=False, timings=None, shortcut=None):
+    """ Predicts labels with a pool of processes, each handling a slab of slices.
+
+    The normalized scan, mask and output volumes live in shared memory, so
+    workers read their patches and write their predictions in place. Unless
+    set in session_options or the config, each worker gets an equal share of
+    the cores for ONNX Runtime's intra-op threads.
+
+    Workers are spawned (not forked), so scripts calling this must guard
+    their entry point with ``if __name__ == "__main__"``.
+
+    Returns
+    -------
+
+    tuple[numpy.ndarray, Optional[numpy.ndarray]]:
+        Label volume and (if requested) probability volume.
+    """
+
+    session_options = dict(session_options or {})
+    if not session_options.get('intra_op_threads', config.ort_options['intra_op_threads']):
+        session_options['intra_op_threads'] = max((os.cpu_count() or 1) // workers, 1)
+
+    shape = image2.shape
+    blocks, arrays = [], {}
+
+    def allocate(key, shape, dtype):
+        shm, array, arrays[key] = shared.create(shape, dtype)
+        blocks.append(shm)
+        return array
+
+    try:
+        allocate('volume', (shape[2], shape[0], shape[1]), np.float32)[...] = image2.transpose(2, 0, 1)
+        allocate('mask', shape, np.bool_)[...] = mask != 0
+        labels = allocate('labels', shape, np.uint8)
+        probability_volume = allocate('probabilities', shape + (5,), np.float16) if probabilities else None
+
+        bounds = shard_bounds(positions, shape[2], workers)
+        context = multiprocessing.get_context('spawn') # ORT sessions and threads do not survive fork
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(bounds)) or 1, mp_context=context) as pool:
+            jobs = [pool.submit(predict_shard, arrays, bound, str(model), batch_size,
+                                session_options, prefetch, shortcut) for bound in bounds]
+
+            for job in jobs:
+                for stage, seconds in job.result().items():
+                    if timings is not None:
+                        timings[stage] = timings.get(stage, 0) + seconds # counters stay int
+
+        labels = labels.copy()
+        probability_volume = probability_volume.copy() if probabilities else None
+
+        return labels, probability_volume
+    finally:
+        shared.release(*blocks, unlink=True)
+
+
+def inference(image, mask, model=None, batch_size=200, max_patch_bytes=None, session_options=None,
+              prefetch=False, timings=None, probabilities=False, workers=1, crop=True, shortcut=None,
+              dtype=None, slice_options=None, connectivity='2d'):
     """ Runs trained model on raw scan, yielding a segmented result.
 
     The raw scan provided is expected to be skull-stripped (no bone regions).
@@ -144,46 +1012,169 @@ def inference(image, mask, model=None, batch_size=200):
     batch_size:
         Size of batches of patches to be fed to model.
 
+    max_patch_bytes:
+        Optional cap on the memory of the batch buffer; batch_size is
+        reduced to fit.
+
+    session_options:
+        Overrides of ``config.ort_options`` (thread counts, execution mode,
+        graph optimization level) for the ONNX Runtime session.
+
+    prefetch:
+        Extract the next batch of patches in a background thread while the
+        model runs on the current one (double buffering).
+
+    timings:
+        Optional dict, filled with the seconds spent per stage: 'extract'
+        (patch extraction), 'wait' (extraction time not hidden behind
+        inference), 'run' (model) and 'scatter' (writing predictions).
+
+    probabilities:
+        Also return the per-class softmax probabilities of the model.
+
+    workers:
+        Number of processes to shard the slices of the scan across. Each
+        runs its own ONNX Runtime session on shared-memory volumes.
+
+    crop:
+        Restrict candidate search, normalization, reconstruction and noise
+        reduction to the bounding box of the mask (plus patch margins), and
+        paste the result back. The result is the same either way.
+
+    shortcut:
+        Settings of a ``UniformShortcut`` (e.g. {} for the defaults) to
+        answer (nearly) constant patches from a per-value cache instead of
+        the model. Approximate; see ``shortcut_disagreement``.
+
+    dtype:
+        Floating point type to load and normalize the scan in (defaults to
+        ``config.volume_dtype``). With float32 the normalized values may
+        differ from float64 in the last bit.
+
+    slice_options:
+        Workers, chunk and executor of the slice-parallel noise reduction
+        (see ``parallel.map_slices``); by default it runs serially.
+
+    connectivity:
+        Island connectivity of the noise reduction, '2d' (default) or '3d'
+        (see ``eliminateNoise``).
+
     Returns
     -------
 
     nibabel.Nifti1Image:
-        Segmented version of raw scan.
+        Segmented version of raw scan, as uint8 labels.
+
+    numpy.ndarray:
+        Only if probabilities is set: float16 array of shape (x, y, z, 5)
+        with the class probabilities of each voxel (zero outside the
+        patches). These are taken before noise reduction.
     """
 
     if model is None:
         model = str(assets.model)
 
-    patches = patch_generator(image.get_fdata(), 
-                              mask.get_fdata(), 
-                              batch_size=batch_size) 
-    # Generates batches of patches (of batch_size)
+    dtype = dtype or config.volume_dtype
+    image_data = image.get_fdata(dtype=dtype)
+    mask_data = mask.get_fdata(dtype=dtype)
 
-    reconstructed = np.zeros_like(image.get_fdata()) # TODO: Look into doing things in-place using given image (but make it option as it is destructive)
-    ort_session = onnxruntime.InferenceSession(model)
+    # Everything up to noise reduction runs inside the crop; labels outside
+    # it are background, which noise reduction leaves as is.
+    bounds = crop_bounds(mask_data) if crop else (slice(None),) * 3
+    image_data, mask_data = image_data[bounds], mask_data[bounds]
 
-    for p, idx in patches:
+    positions = find_centers(mask_data)
 
-        # compute ONNX Runtime output prediction
-        p = np.moveaxis(p, -1, 1)
-        ort_inputs = {ort_session.get_inputs()[0].name: p.astype(np.float32)}
-        ort_outs = ort_session.run(None, ort_inputs)[0]
-        ort_outs = ort_outs.reshape((ort_outs.shape[0], 5, 2, 2))
+    batch_size = limit_batch_size(batch_size, max_patch_bytes, itemsize=4)
+    if batch_size == 'max':
+        batch_size = max(len(positions), 1)
 
-        softmax_out = softmax(ort_outs, axis=1)
-        pred = np.argmax(softmax_out, axis=1)
-        #breakpoint()
+    if timings is None:
+        timings = {}
+    timings.update(extract=0.0, wait=0.0, run=0.0, scatter=0.0)
 
-        # logging.info(f"reconstructed.shape = {reconstructed.shape}")
-        # logging.info(f"pred.shape = {pred.shape}")
-        for k in range(pred.shape[0]):
-            x, y, z = idx[k]
-            reconstructed[x:x+1+1,y:y+1+1,z] = pred[k,0,...]
+    if workers > 1:
+        reconstructed, probability_volume = sharded_predict(normalize(image_data), mask_data, positions,
+                                                            workers, model, batch_size, session_options,
+                                                            prefetch, probabilities, timings, shortcut)
+    else:
+        volume, view = patch_volume(normalize(image_data))
+        offsets = patch_offsets(image_data.shape, positions)
+
+        reconstructed = np.zeros(image_data.shape, dtype=np.uint8) # class labels only
+        probability_volume = np.zeros(image_data.shape + (5,), dtype=np.float16) if probabilities else None
+        engine = InferenceEngine(model, batch_size, session_options, n_buffers=2 if prefetch else 1)
+
+        predict(engine, view, offsets, positions, reconstructed, probability_volume, prefetch, timings,
+                None if shortcut is None else UniformShortcut(**shortcut))
+
+    logging.info("Inference stages: extract %.2fs (%.2fs hidden by prefetch), run %.2fs, scatter %.2fs",
+                 timings['extract'], timings['extract'] - timings['wait'], timings['run'], timings['scatter'])
+
+    if shortcut is not None:
+        logging.info("Uniform shortcut: %d of %d patches answered without the model, "
+                     "for %d model calls (%d patch evaluations saved)",
+                     timings['shortcut_patches'], timings['patches'], timings['model_calls'],
+                     timings['shortcut_patches'] - timings['model_calls'])
 
     # Noise Reduction
-    result_noNoise = eliminateNoise(reconstructed, minArea=64)
-    filldots = cutoff(result_noNoise)
+    filldots = np.zeros(image.shape, dtype=np.uint8)
+    filldots[bounds] = parallel_denoise(reconstructed, minArea=64, connectivity=connectivity,
+                                        slice_options=slice_options)
+
+    if probabilities:
+        cropped, probability_volume = probability_volume, np.zeros(image.shape + (5,), dtype=np.float16)
+        probability_volume[bounds] = cropped
+
+    header = image.header.copy()
+    header.set_data_dtype(np.uint8)
+    final = nib.Nifti1Image(filldots, affine=None, header=header)
 
-    final = nib.Nifti1Image(filldots, affine=None, header=image.header)
+    if probabilities:
+        return final, probability_volume
 
     return final
+
+
+def shortcut_disagreement(volumes, model=None, batch_size=5000, **shortcut):
+    """ Measures the uniform-patch shortcut against plain inference.
+
+    Parameters
+    ----------
+
+    volumes: Iterable[tuple[nibabel.nifti1.Nifti1Image, nibabel.nifti1.Nifti1Image]]
+        Validation scans and their masks (as passed to ``inference``).
+
+    **shortcut:
+        ``UniformShortcut`` settings.
+
+    Returns
+    -------
+
+    dict[str, float]:
+        'patches', 'shortcut_patches' (patches answered from the cache),
+        'model_calls' (made to fill it), 'avoided' (fraction of patch
+        evaluations saved, net of those calls) and 'disagreement' (fraction of mask
+        voxels whose final label differs).
+    """
+
+    patches, shortcut_patches, model_calls, differ, total = 0, 0, 0, 0, 0
+
+    for image, mask in volumes:
+        timings = {}
+        exact = np.asarray(inference(image, mask, model, batch_size).dataobj)
+        approx = np.asarray(inference(image, mask, model, batch_size, shortcut=shortcut, timings=timings).dataobj)
+        brain = mask.get_fdata() != 0
+
+        patches += timings['patches']
+        shortcut_patches += timings['shortcut_patches']
+        model_calls += timings['model_calls']
+        differ += int(np.count_nonzero((exact != approx) & brain))
+        total += int(np.count_nonzero(brain))
+
+    return {'patches': patches,
+            'shortcut_patches': shortcut_patches,
+            'model_calls': model_calls,
+            'avoided': (shortcut_patches - model_calls) / max(patches, 1),
+            'disagreement': differ / max(total, 1),
+           }
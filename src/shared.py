@@ -0,0 +1,67 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def create(shape, dtype):
+    """ Allocates a zeroed array in a new shared memory block.
+
+    Parameters
+    ----------
+
+    shape: tuple[int, ...]
+        Shape of the array.
+
+    dtype: numpy.dtype | str
+        Data type of the array.
+
+    Returns
+    -------
+
+    tuple[multiprocessing.shared_memory.SharedMemory, numpy.ndarray, tuple]:
+        The block (to be closed and unlinked by the caller), the array
+        backed by it, and a picklable spec for ``attach`` in other processes.
+    """
+
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array[...] = 0
+
+    return shm, array, (shm.name, tuple(shape), dtype.str)
+
+def attach(spec):
+    """ Maps an array created by ``create`` in another process.
+
+    The block stays owned by its creator, which must unlink it. Worker
+    processes started by the creator share its resource tracker, so
+    attaching does not register the block a second time.
+
+    Returns
+    -------
+
+    tuple[multiprocessing.shared_memory.SharedMemory, numpy.ndarray]:
+        The block (to be closed by the caller) and the array backed by it.
+    """
+
+    name, shape, dtype = spec
+
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def release(*blocks, unlink=False):
+    """ Closes (and optionally unlinks) shared memory blocks.
+
+    Arrays backed by a block must be dropped before it can be closed.
+    """
+
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError: # still referenced (e.g. by a traceback); freed at exit
+            pass
+
+        if unlink:
+            shm.unlink()
@@ -0,0 +1,35 @@
+import pathlib
+import sys
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+
+import assets
+
+
+def test_prob_map_same_with_and_without_pack(monkeypatch, tmp_path):
+    """ The pack only changes where the codes are read from, never the type or values.
+    """
+
+    monkeypatch.setattr(assets, 'prob_maps', {})
+    monkeypatch.setattr(assets, 'pack_dir', tmp_path / "missing")
+    unpacked = assets.load_prob_map('ventr')
+
+    monkeypatch.setattr(assets, 'prob_maps', {})
+    monkeypatch.setattr(assets, 'pack_dir', tmp_path / "pack")
+    assets.build_pack()
+    packed = assets.load_prob_map('ventr')
+
+    assert type(unpacked) is type(packed) is assets.ProbMap
+    assert isinstance(packed.codes, np.memmap) and not isinstance(unpacked.codes, np.memmap)
+    assert np.array_equal(np.asarray(unpacked), np.asarray(packed))
+
+    decoded = np.asarray(packed)
+    for threshold in (0, 0.3, 0.5, 1):
+        assert np.array_equal(packed >= threshold, decoded >= threshold)
+        assert np.array_equal(packed > threshold, decoded > threshold)
+        assert np.array_equal(packed <= threshold, decoded <= threshold)
+        assert np.array_equal(packed < threshold, decoded < threshold)
+
+    assert np.array_equal(packed[:, :, 90], decoded[:, :, 90])
@@ -0,0 +1,44 @@
+import pathlib
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+
+import assets
+import postprocess as post
+
+
+def segmentation(rng):
+    """ Labels on the MNI grid: small ventricle blobs on a few slices, and one slice
+    that is all ventricle but for a small patch, so "component 0" is small too.
+    """
+
+    template = nib.load(assets.MNI_152_bone)
+    labels = np.zeros(template.shape, dtype=np.uint8)
+
+    for k in (60, 90, 100):
+        labels[..., k] = rng.choice([0, 2, 4], size=labels.shape[:2], p=[0.8, 0.1, 0.1])
+        for i, j in rng.integers(10, 200, (40, 2)):
+            size = rng.integers(2, 30)
+            labels[i:i+size, j:j+size, k] = 1
+
+    labels[..., 80] = 1
+    labels[40:60, 100:120, 80] = 0 # 400 voxels, under the 600 of the size test
+
+    return nib.Nifti1Image(labels, template.affine)
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_correct_matches_reference(workers):
+    img = segmentation(np.random.default_rng(0))
+
+    expected = np.asanyarray(post.correct(img, reference=True).dataobj)
+    corrected = np.asanyarray(post.correct(img, slice_options={'workers': workers}).dataobj)
+
+    labels = np.asanyarray(img.dataobj)
+    assert np.any((labels[..., 80] == 0) & (expected[..., 80] == 3)) # component 0 relabelled
+    assert np.any((labels == 1) & (expected == 3)) # small ventricle components relabelled
+
+    assert np.array_equal(corrected, expected)
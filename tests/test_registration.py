@@ -0,0 +1,136 @@
+import pathlib
+import shutil
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+
+import assets
+import preprocess as pre
+import registration as reg
+import registration_benchmark as bench
+import segmentation as seg
+
+
+def mni_scan(rng):
+    template = nib.load(assets.MNI_152_bone)
+    data = rng.random(template.shape) * 80
+
+    return nib.Nifti1Image(data, template.affine, template.header)
+
+def test_native_backend_resamples_pipeline_images(monkeypatch):
+    """ skullstrip and inference outputs carry affine=None; their geometry is in the header.
+    """
+
+    monkeypatch.setattr(reg, 'MNI_152', assets.MNI_152_bone)
+
+    rng = np.random.default_rng(0)
+    raw_scan = nib.Nifti1Image(np.zeros((96, 96, 12), dtype=np.float32), np.diag([2.0, 2.0, 5.0, 1.0]))
+    mtx = np.diag([0.5, 0.5, 1.0, 1.0]) # CT to MNI
+    mtx[:3, 3] = [40, 60, 30]
+
+    rest, mask = pre.skullstrip(mni_scan(rng))
+    assert rest.affine is None
+
+    ct_rest, inverse = reg.MNI_to_CT(rest, raw_scan, mtx, backend='native')
+    ct_mask, _ = reg.MNI_to_CT(mask, raw_scan, reuse=inverse, backend='native')
+
+    assert ct_rest.shape == raw_scan.shape
+    assert np.count_nonzero(np.asanyarray(ct_mask.dataobj)) > 0
+
+    # Same result as with the geometry given explicitly
+    explicit = nib.Nifti1Image(np.asanyarray(rest.dataobj), rest.header.get_best_affine(), rest.header)
+    expected, _ = reg.MNI_to_CT(explicit, raw_scan, reuse=inverse, backend='native')
+    assert np.array_equal(np.asanyarray(ct_rest.dataobj), np.asanyarray(expected.dataobj))
+
+    segmented = seg.inference(ct_rest, ct_mask, batch_size=5000)
+    assert segmented.affine is None
+
+    registered = reg.apply_affine(segmented, mtx, backend='native')
+
+    assert registered.shape == nib.load(assets.MNI_152_bone).shape
+    assert registered.get_data_dtype() == np.uint8
+
+requires_fsl = pytest.mark.skipif(shutil.which('flirt') is None or reg.fl is None,
+                                  reason="needs FSL (flirt) and fslpy")
+
+def voxels(img):
+    """ Data of a nibabel or fslpy image (FSL results are loaded by fslpy).
+    """
+
+    return np.asanyarray(getattr(img, 'nibImage', img).dataobj)
+
+def grid(shape, zooms, flip):
+    """ Affine of a grid; flip=True stores x left to right (negative determinant).
+    """
+
+    affine = np.diag([-zooms[0] if flip else zooms[0], zooms[1], zooms[2], 1.0])
+    affine[:3, 3] = -affine[:3, :3] @ (np.array(shape) / 2)
+
+    return affine
+
+def images(rng, flip_src, flip_ref):
+    """ Smooth float32 and label source images, an empty reference, and a FLIRT matrix between them.
+    """
+
+    shape = (40, 44, 20)
+    smooth = ndimage.gaussian_filter(rng.random(shape), 2).astype(np.float32) * 1000
+    labels = np.digitize(smooth, np.quantile(smooth, [0.2, 0.4, 0.6, 0.8])).astype(np.uint8)
+
+    affine = grid(shape, (2.0, 2.0, 4.0), flip_src)
+    src = nib.Nifti1Image(smooth, affine)
+    src_labels = nib.Nifti1Image(labels, affine)
+
+    ref_shape = (50, 48, 24)
+    ref = nib.Nifti1Image(np.zeros(ref_shape, dtype=np.float32), grid(ref_shape, (1.5, 1.5, 3.0), flip_ref))
+
+    p = np.concatenate([rng.uniform(-4, 4, 3), np.deg2rad(rng.uniform(-10, 10, 3)), rng.uniform(-0.05, 0.05, 6)])
+    mtx = reg.params_affine(p, reg.center_of_mass(src))
+
+    return src, src_labels, ref, mtx
+
+def nearest_agree(native, fsl):
+    """ FLIRT computes in float32, so coordinates on a rounding tie may snap either way.
+    """
+
+    return native.shape == fsl.shape and np.mean(native != fsl) < 1e-4
+
+@requires_fsl
+@pytest.mark.parametrize('flip_src', [False, True])
+@pytest.mark.parametrize('flip_ref', [False, True])
+def test_native_backend_matches_fsl(flip_src, flip_ref):
+    src, src_labels, ref, mtx = images(np.random.default_rng(1), flip_src, flip_ref)
+
+    native = voxels(reg.transform(src_labels, ref, mtx, interp='nearestneighbour', backend='native'))
+    fsl = voxels(reg.transform(src_labels, ref, mtx, interp='nearestneighbour', backend='fsl'))
+    assert np.count_nonzero(native) > native.size // 2
+    assert nearest_agree(native, fsl)
+
+    native = voxels(reg.transform(src, ref, mtx, interp='trilinear', backend='native'))
+    fsl = voxels(reg.transform(src, ref, mtx, interp='trilinear', backend='fsl'))
+    assert np.allclose(native, fsl, atol=1e-3 * np.ptp(fsl))
+
+    assert np.allclose(reg.invert(mtx, backend='native'), reg.invert(mtx, backend='fsl'), atol=1e-6)
+
+    # Back to the source grid, as MNI_to_CT brings segmentations to the CT
+    moved = reg.transform(src_labels, ref, mtx, interp='nearestneighbour', backend='native')
+    native, inverse = reg.MNI_to_CT(moved, src, mtx, backend='native')
+    fsl, fsl_inverse = reg.MNI_to_CT(moved, src, mtx, backend='fsl')
+
+    assert np.allclose(inverse, fsl_inverse, atol=1e-6)
+    assert nearest_agree(voxels(native), voxels(fsl))
+
+def test_native_engine_registers_ct_phantom():
+    """ A CT in HU, through CT_to_MNI as the pipeline runs it, against the bone template.
+    """
+
+    src, true = bench.phantom(bench.head(), np.random.default_rng(0))
+
+    mtx = reg.CT_to_MNI(src, apply_transformation=False, engine='native')
+    rms, _ = bench.displacement(mtx, true, nib.load(assets.MNI_152_bone))
+
+    assert rms < 1
@@ -0,0 +1,103 @@
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / "src"))
+
+import segmentation as seg
+
+
+def blobs(rng, shape, scale=4):
+    """ Random uint8 labels 0-4 in blocks of scale voxels, sprinkled with single-voxel noise.
+    """
+
+    coarse = rng.integers(0, 5, (shape[0] // scale, shape[1] // scale, shape[2]))
+    labels = np.kron(coarse, np.ones((scale, scale, 1), dtype=np.int64))
+    noise = rng.random(shape) < 0.1
+    labels[noise] = rng.integers(0, 5, np.count_nonzero(noise))
+
+    return labels.astype(np.uint8)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_eliminate_noise_matches_reference(seed):
+    labels = blobs(np.random.default_rng(seed), (40, 36, 5))
+
+    for minArea in (4, 16):
+        assert np.array_equal(seg.eliminateNoise(labels, minArea=minArea),
+                              seg.eliminateNoise_reference(labels, minArea=minArea))
+
+@pytest.mark.parametrize('seed', range(3))
+def test_cutoff_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    labels = np.where(rng.random((30, 28, 4)) < 0.15, 2, 3).astype(np.uint8)
+    labels[rng.random(labels.shape) < 0.02] = 1
+
+    expected = seg.cutoff_reference(labels.copy())
+
+    assert np.count_nonzero(expected != labels) > 0 # some voxels are relabelled
+    assert np.array_equal(seg.cutoff(labels.copy()), expected)
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_parallel_denoise_matches_whole_volume(executor):
+    labels = blobs(np.random.default_rng(0), (40, 40, 9))
+
+    expected = seg.denoise(labels.copy(), minArea=16)
+    slabs = seg.parallel_denoise(labels, minArea=16, slice_options={'workers': 2, 'chunk': 2,
+                                                                     'executor': executor})
+
+    assert np.array_equal(slabs, expected)
+
+def border_mask(rng, shape):
+    """ Sparse random mask with voxels on and near every face of the volume.
+    """
+
+    mask = rng.random(shape) < 0.01
+    for axis, n in enumerate(shape):
+        for index in {0, 1, min(17, n - 1), max(n - 18, 0), n - 2, n - 1}:
+            face = [slice(None)] * 3
+            face[axis] = index
+            mask[tuple(face)] |= rng.random(mask[tuple(face)].shape) < 0.05
+
+    return mask.astype(np.uint8)
+
+@pytest.mark.parametrize('shape', [(60, 58, 6), (51, 64, 3), (70, 41, 8)])
+@pytest.mark.parametrize('batch_size', [7, 'max'])
+def test_patch_generator_matches_loop(shape, batch_size):
+    rng = np.random.default_rng(sum(shape))
+    image = rng.normal(40, 80, shape)
+    mask = border_mask(rng, shape)
+
+    batches = zip(seg.patch_generator(image, mask, batch_size), seg.patch_generator(image, mask, batch_size,
+                                                                                      vectorized=False),
+                  strict=True)
+
+    for (patches, positions), (expected_patches, expected_positions) in batches:
+        assert np.array_equal(positions, np.array(expected_positions).reshape(-1, 3))
+        assert np.array_equal(patches, expected_patches)
+
+@pytest.mark.parametrize('seed', range(6))
+def test_cropped_centers_match_whole_mask(seed):
+    rng = np.random.default_rng(seed)
+    image = rng.normal(40, 80, (81, 76, 7))
+    mask = np.zeros(image.shape, dtype=np.uint8)
+
+    # A sparse blob somewhere in the volume, often against its borders
+    start = rng.integers(0, [70, 66, 5])
+    stop = np.minimum(start + rng.integers([10, 10, 1], [50, 50, 5]), image.shape)
+    mask[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = rng.random(stop - start) < 0.3
+
+    crop = seg.crop_bounds(mask)
+    offset = np.array([s.start or 0 for s in crop])
+
+    positions = seg.find_centers(mask)
+    cropped = seg.find_centers(mask[crop]) + offset
+
+    assert np.array_equal(cropped, positions)
+    if len(positions):
+            assert np.array_equal(seg.gather_patches(image[crop], cropped - offset),
+                              seg.gather_patches(image, positions))
+
+def test_crop_of_empty_mask_is_whole_volume():
+    assert seg.crop_bounds(np.zeros((40, 40, 5))) == (slice(None),) * 3